@@ -21,30 +21,34 @@ import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('TelepathyGLib', '0.12')
 
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
 from gi.repository import TelepathyGLib
-from gi.repository import GLib
 
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 
 OSK_HEIGHT = [400, 300]
 SLASH = '-x-SLASH-x-'  # slash safe encoding
+SEARCH_DELAY = 300  # ms of typing pause before searching
 
 import logging
 import json
 import os
 import time
+import shutil
 import dbus
 from gettext import gettext as _
+from gettext import ngettext
 
 from sugar3.graphics import style
 from sugar3.graphics.icon import EventIcon, Icon
 from sugar3.graphics.alert import NotifyAlert
 from sugar3.graphics.toolbarbox import ToolbarBox
 from sugar3.graphics.toolbutton import ToolButton
+from sugar3.graphics.palettemenu import PaletteMenuItem
 from sugar3.activity import activity
 from sugar3.activity.activity import get_bundle_path
 from sugar3.presence import presenceservice
@@ -58,9 +62,28 @@ from sugar3.graphics import iconentry
 
 from chat import smilies
 from chat.box import ChatBox
+from chat.archive import open_archive
+from chat.geometry import Geometry
+from chat.history import History
+from chat.smileytable import SmileyTable
 
 logger = logging.getLogger('chat-activity')
 
+# Size of the icons of the smiley table
+SMILEY_TABLE_SIZE = (style.STANDARD_ICON_SIZE + style.LARGE_ICON_SIZE) // 2
+
+# Bytes of memory below which the conversation is drawn in one TextView
+# rather than with a widget per bubble, see ChatBox
+SINGLE_BUFFER_MEMORY = 512 * 1024 * 1024
+
+
+def _is_low_memory():
+    try:
+        memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return False
+    return memory < SINGLE_BUFFER_MEMORY
+
 
 Gst.init([])
 
@@ -72,12 +95,30 @@ class Chat(activity.Activity):
         pservice = presenceservice.get_instance()
         self.owner = pservice.get_owner()
 
-        self.chatbox = ChatBox(self.owner)
+        # Sizes derived from the screen size, see _configure_cb
+        self.geometry = Geometry()
+
+        # Old messages are moved to the spill file, see ChatBox
+        spill_path = os.path.join(get_activity_root(), 'instance',
+                                  'spill-%s' % handle.activity_id)
+        self.chatbox = ChatBox(self.owner, single_buffer=_is_low_memory(),
+                               geometry=self.geometry, spill_path=spill_path)
+        # Copy of the journal file read, see read_file
+        self._history_path = None
         self.chatbox.connect('open-on-journal', self.__open_on_journal)
         self.chatbox.connect('new-message',
                              self._search_entry_on_new_message_cb)
+        self.chatbox.connect('search-updated', self._search_updated_cb)
+        self._search_timeout_id = None
+
+        # Messages of every saved chat, None if SQLite lacks full text
+        # search
+        self._archive = open_archive(
+            os.path.join(get_activity_root(), 'data', 'archive.db'))
 
         super(Chat, self).__init__(handle)
+        # After write_file, which reads the records not in memory
+        self.connect('destroy', self._destroy_cb)
 
         self._entry = None
         self._has_alert = False
@@ -86,6 +127,10 @@ class Chat(activity.Activity):
 
         self._entry.grab_focus()
 
+        # Rasterize smilies while idle, before the first one is received
+        # or the smiley table is shown
+        smilies.prewarm(SMILEY_TABLE_SIZE)
+
         toolbar_box = ToolbarBox()
         self.set_toolbar_box(toolbar_box)
 
@@ -96,12 +141,13 @@ class Chat(activity.Activity):
         self._activity_toolbar_button.show()
 
         self.search_entry = iconentry.IconEntry()
-        self.search_entry.set_size_request(Gdk.Screen.width() / 3, -1)
+        self.search_entry.set_size_request(self.geometry.screen_width / 3,
+                                           -1)
         self.search_entry.set_icon_from_name(
             iconentry.ICON_ENTRY_PRIMARY, 'entry-search')
         self.search_entry.add_clear_button()
         self.search_entry.connect('activate', self._search_entry_activate_cb)
-        self.search_entry.connect('changed', self._search_entry_activate_cb)
+        self.search_entry.connect('changed', self._search_entry_changed_cb)
 
         self.connect('key-press-event', self._search_entry_key_press_cb)
 
@@ -123,6 +169,19 @@ class Chat(activity.Activity):
         self._search_next.props.sensitive = False
         toolbar_box.toolbar.insert(self._search_next, -1)
 
+        self._search_count = Gtk.Label()
+        self._search_count.set_margin_left(style.DEFAULT_SPACING)
+        search_count_item = Gtk.ToolItem()
+        search_count_item.add(self._search_count)
+        toolbar_box.toolbar.insert(search_count_item, -1)
+
+        if self._archive is not None:
+            self._search_archive = ToolButton('system-search')
+            self._search_archive.set_tooltip(_('Search all chats'))
+            self._search_archive.connect('clicked', self._search_archive_cb)
+            self._search_archive.props.sensitive = False
+            toolbar_box.toolbar.insert(self._search_archive, -1)
+
         separator = Gtk.SeparatorToolItem()
         separator.props.draw = False
         separator.set_expand(True)
@@ -174,23 +233,43 @@ class Chat(activity.Activity):
             self._entry.grab_focus()
 
     def _search_entry_on_new_message_cb(self, chatbox):
+        # The chatbox finds the matches of the new text itself
+        self._update_search_buttons()
+
+    def _search_entry_changed_cb(self, entry):
+        # Wait for a pause in the typing
+        if self._search_timeout_id is not None:
+            GLib.source_remove(self._search_timeout_id)
+        self._search_timeout_id = GLib.timeout_add(
+            SEARCH_DELAY, self._search_timeout_cb)
+
+    def _search_timeout_cb(self):
+        self._search_timeout_id = None
         self._search_entry_activate_cb(self.search_entry)
+        return False
 
     def _search_entry_activate_cb(self, entry):
-        for i in range(0, self.chatbox.number_of_textboxes()):
-            textbox = self.chatbox.get_textbox(i)
-            _buffer = textbox.get_buffer()
-            start_mark = _buffer.get_mark('start')
-            end_mark = _buffer.get_mark('end')
-            if start_mark is None or end_mark is None:
-                continue
-            _buffer.delete_mark(start_mark)
-            _buffer.delete_mark(end_mark)
-            self.chatbox.highlight_text = (None, None, None)
-        self.chatbox.set_search_text(entry.props.text)
+        if self._search_timeout_id is not None:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = None
+        self.chatbox.search_async(entry.props.text)
+        self._update_search_buttons()
+
+    def _search_updated_cb(self, chatbox):
         self._update_search_buttons()
+        if len(self.chatbox.search_text) == 0:
+            self._search_count.set_text('')
+        else:
+            count = self.chatbox.get_match_count()
+            text = ngettext('%d match', '%d matches', count) % count
+            if self.chatbox.is_searching():
+                text += '…'
+            self._search_count.set_text(text)
 
     def _update_search_buttons(self,):
+        if self._archive is not None:
+            self._search_archive.props.sensitive = \
+                len(self.chatbox.search_text) > 0
         if len(self.chatbox.search_text) == 0:
             self._search_prev.props.sensitive = False
             self._search_next.props.sensitive = False
@@ -211,6 +290,31 @@ class Chat(activity.Activity):
             self.chatbox.search('forward')
             self._update_search_buttons()
 
+    def _search_archive_cb(self, button):
+        ''' Show the best matches of the search text in every saved chat
+        '''
+        box = Gtk.VBox()
+        hits = self._archive.search(self.search_entry.props.text)
+        for hit in hits:
+            item = PaletteMenuItem('%s, %s: %s' % (
+                hit.title or _('Chat'), hit.nick, hit.snippet))
+            item.connect('activate', self._archive_hit_cb, hit)
+            box.pack_start(item, False, False, 0)
+        if not hits:
+            item = PaletteMenuItem(_('No matches'))
+            item.props.sensitive = False
+            box.pack_start(item, False, False, 0)
+        box.show_all()
+        palette = button.get_palette()
+        palette.set_content(box)
+        palette.popup(immediate=True)
+
+    def _archive_hit_cb(self, item, hit):
+        if hit.session == self.get_id():
+            self.chatbox.show_timestamp(hit.timestamp)
+        elif hit.object_id is not None:
+            show_object_in_journal(hit.object_id)
+
     def _fixed_resize_cb(self, widget=None, rect=None):
         ''' If a toolbar opens or closes, we need to resize the vbox
         holding out scrolling window. '''
@@ -237,7 +341,8 @@ class Chat(activity.Activity):
         ''' Create a canvas '''
         self._fixed = Gtk.Fixed()
         self._fixed.set_size_request(
-            Gdk.Screen.width(), Gdk.Screen.height() - style.GRID_CELL_SIZE)
+            self.geometry.screen_width,
+            self.geometry.screen_height - style.GRID_CELL_SIZE)
         self._fixed.connect('size-allocate', self._fixed_resize_cb)
         self.set_canvas(self._fixed)
         self._fixed.show()
@@ -253,78 +358,42 @@ class Chat(activity.Activity):
         Gdk.Screen.get_default().connect('size-changed', self._configure_cb)
 
     def _configure_cb(self, event):
+        # The chatbox follows the geometry itself
+        self.geometry.update()
         self._fixed.set_size_request(
-            Gdk.Screen.width(), Gdk.Screen.height() - style.GRID_CELL_SIZE)
+            self.geometry.screen_width,
+            self.geometry.screen_height - style.GRID_CELL_SIZE)
         self._entry_height = style.GRID_CELL_SIZE
-        entry_width = Gdk.Screen.width() - \
+        entry_width = self.geometry.screen_width - \
             2 * (self._entry_height + style.GRID_CELL_SIZE)
         self._entry.set_size_request(entry_width, self._entry_height)
         self._entry_grid.set_size_request(
-            Gdk.Screen.width() - 2 * style.GRID_CELL_SIZE,
+            self.geometry.screen_width - 2 * style.GRID_CELL_SIZE,
             self._entry_height)
 
-        self._chat_height = Gdk.Screen.height() - self._entry_height - \
-            style.GRID_CELL_SIZE
-        self._chat_width = Gdk.Screen.width()
+        self._chat_height = self.geometry.screen_height - \
+            self._entry_height - style.GRID_CELL_SIZE
+        self._chat_width = self.geometry.screen_width
         self.chatbox.set_size_request(self._chat_width, self._chat_height)
-        self.chatbox.resize_all()
 
-        width = int(Gdk.Screen.width() - 2 * style.GRID_CELL_SIZE)
-        height = int(Gdk.Screen.height() - 5 * style.GRID_CELL_SIZE)
-        self._smiley_table.set_size_request(width, height)
-        self._smiley_toolbar.set_size_request(width, -1)
-        self._smiley_window.set_size_request(width, -1)
+        if hasattr(self, '_smiley_window'):
+            width = int(self.geometry.screen_width - 2 * style.GRID_CELL_SIZE)
+            height = int(self.geometry.screen_height -
+                         5 * style.GRID_CELL_SIZE)
+            self._smiley_table.set_size_request(width, height)
+            self._smiley_picker.set_width(width)
+            self._smiley_toolbar.set_size_request(width, -1)
+            self._smiley_window.set_size_request(width, -1)
 
         self._fixed_resize_cb()
 
     def _create_smiley_table(self, width):
-        pixel_size = (style.STANDARD_ICON_SIZE + style.LARGE_ICON_SIZE) / 2
-        spacing = style.DEFAULT_SPACING
-        button_size = pixel_size + spacing
-        smilies_columns = int(width / button_size)
-        pad = (width - smilies_columns * button_size) / 2
-
-        table = Gtk.Grid()
-        table.set_row_spacing(spacing)
-        table.set_column_spacing(spacing)
-        table.set_border_width(pad)
-
-        queue = []
-
-        def _create_smiley_icon_idle_cb():
-            try:
-                x, y, path, code = queue.pop()
-            except IndexError:
-                self.unbusy()
-                return False
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path,
-                                                            pixel_size,
-                                                            pixel_size)
-            image = Gtk.Image.new_from_pixbuf(pixbuf)
-            box = Gtk.EventBox()
-            box.add(image)
-            box.connect('button-press-event', self._add_smiley_to_entry, code)
-            table.attach(box, x, y, 1, 1)
-            box.show_all()
-            return True
-
-        x = 0
-        y = 0
-        smilies.init()
-        for i in range(len(smilies.THEME)):
-            path, hint, codes = smilies.THEME[i]
-            queue.append([x, y, path, codes[0]])
-
-            x += 1
-            if x == smilies_columns:
-                y += 1
-                x = 0
-
-        queue.reverse()
-        GLib.idle_add(_create_smiley_icon_idle_cb)
+        table = SmileyTable(SMILEY_TABLE_SIZE, style.DEFAULT_SPACING)
+        table.set_width(width)
+        table.connect('smiley-activated', self._add_smiley_to_entry)
         return table
 
-    def _add_smiley_to_entry(self, icon, event, text):
+    def _add_smiley_to_entry(self, table, text):
         pos = self._entry.props.cursor_position
         self._entry.insert_text(text, pos)
         self._entry.grab_focus()
@@ -519,17 +588,17 @@ class Chat(activity.Activity):
         ---------------------------------------
         '''
         self._entry_height = style.GRID_CELL_SIZE
-        entry_width = Gdk.Screen.width() - \
+        entry_width = self.geometry.screen_width - \
             2 * (self._entry_height + style.GRID_CELL_SIZE)
-        self._chat_height = Gdk.Screen.height() - self._entry_height - \
-            style.GRID_CELL_SIZE
-        self._chat_width = Gdk.Screen.width()
+        self._chat_height = self.geometry.screen_height - \
+            self._entry_height - style.GRID_CELL_SIZE
+        self._chat_width = self.geometry.screen_width
 
         self.chatbox.set_size_request(self._chat_width, self._chat_height)
 
         self._entry_grid = Gtk.Grid()
         self._entry_grid.set_size_request(
-            Gdk.Screen.width() - 2 * style.GRID_CELL_SIZE,
+            self.geometry.screen_width - 2 * style.GRID_CELL_SIZE,
             self._entry_height)
 
         self.smiley_button = EventIcon(icon_name='smilies',
@@ -636,10 +705,19 @@ class Chat(activity.Activity):
         self.chatbox.add_log_timestamp()
         f = open(file_path, 'w')
         try:
-            f.write(self.chatbox.get_log())
+            self.chatbox.write_log(f)
         finally:
             f.close()
         self.metadata['mime_type'] = 'text/plain'
+        if self._archive is not None:
+            if self._archive.has_session(self.get_id()):
+                records = self.chatbox.get_session_records()
+            else:
+                # The first time, the records of the resumed log too
+                records = self.chatbox.get_records()
+            self._archive.add(self.get_id(), records,
+                              self._jobject.object_id,
+                              self.metadata.get('title'))
 
     def read_file(self, file_path):
         '''Load a chat log from the Journal.
@@ -647,20 +725,26 @@ class Chat(activity.Activity):
         to define this method.
         '''
         logger.debug('read_file: reading %s' % file_path)
-        log = open(file_path).readlines()
-        last_line_was_timestamp = False
-        for line in log:
-            if line.endswith('\t\t\n'):
-                if last_line_was_timestamp is False:
-                    timestamp = line.strip().split('\t')[0]
-                    self.chatbox.add_separator(timestamp)
-                    last_line_was_timestamp = True
-            else:
-                timestamp, nick, color, status, text = line.strip().split('\t')
-                status_message = bool(int(status))
-                self.chatbox.add_text({'nick': nick, 'color': color},
-                                      text, status_message)
-                last_line_was_timestamp = False
+        # The older records are read as they are scrolled to, from a
+        # copy, as the journal may remove file_path meanwhile
+        history_path = os.path.join(get_activity_root(), 'instance',
+                                    'history-%s' % self.get_id())
+        if os.path.exists(history_path):
+            os.unlink(history_path)
+        try:
+            os.link(file_path, history_path)
+        except OSError:
+            shutil.copyfile(file_path, history_path)
+        self.chatbox.load_history(History(history_path))
+        self._history_path = history_path
+
+    def _destroy_cb(self, activity):
+        ''' Remove the files of the records not in memory '''
+        self.chatbox.close()
+        if self._archive is not None:
+            self._archive.close()
+        if self._history_path is not None:
+            os.unlink(self._history_path)
 
     def play_sound(self, event):
         SOUNDS_PATH = os.path.join(get_bundle_path(), 'sounds')
@@ -674,7 +758,7 @@ class Chat(activity.Activity):
 
     def _create_smiley_window(self):
         grid = Gtk.Grid()
-        width = int(Gdk.Screen.width() - 2 * style.GRID_CELL_SIZE)
+        width = int(self.geometry.screen_width - 2 * style.GRID_CELL_SIZE)
 
         self._smiley_toolbar = SmileyToolbar(self)
         height = style.GRID_CELL_SIZE
@@ -687,12 +771,12 @@ class Chat(activity.Activity):
                                       Gtk.PolicyType.AUTOMATIC)
         self._smiley_table.modify_bg(
             Gtk.StateType.NORMAL, style.COLOR_BLACK.get_gdk_color())
-        height = int(Gdk.Screen.height() - 4 * style.GRID_CELL_SIZE)
+        height = int(self.geometry.screen_height - 4 * style.GRID_CELL_SIZE)
         self._smiley_table.set_size_request(width, height)
 
-        table = self._create_smiley_table(width)
-        self._smiley_table.add_with_viewport(table)
-        table.show_all()
+        self._smiley_picker = self._create_smiley_table(width)
+        self._smiley_table.add_with_viewport(self._smiley_picker)
+        self._smiley_picker.show()
 
         grid.attach(self._smiley_table, 0, 1, 1, 1)
         self._smiley_table.show()
@@ -718,8 +802,12 @@ class Chat(activity.Activity):
 
     def _show_smiley_window(self):
         if not hasattr(self, '_smiley_window'):
+            # The atlas may not be drawn yet, see smilies.prewarm
             self.busy()
-            self._create_smiley_window()
+            try:
+                self._create_smiley_window()
+            finally:
+                self.unbusy()
         self._smiley_window.show()
 
     def _hide_smiley_window(self):
@@ -0,0 +1,148 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' The messages of every saved chat, in a SQLite database with a full
+text index, for searching all of them at once '''
+
+import logging
+import sqlite3
+
+# Full text search modules, best first, with their table and the ranked
+# query of the hits
+_MODULES = (
+    ('fts5',
+     'CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5('
+     'text, nick UNINDEXED, session UNINDEXED, timestamp UNINDEXED)',
+     "SELECT session, object_id, title, timestamp, nick, "
+     "snippet(messages, 0, '', '', '…', 8) "
+     "FROM messages JOIN sessions ON sessions.id = messages.session "
+     "WHERE messages MATCH ? ORDER BY rank LIMIT ?"),
+    # FTS4 has no ranking function, the newest hits come first
+    ('fts4',
+     'CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts4('
+     'text, nick, session, timestamp, notindexed=nick, notindexed=session, '
+     'notindexed=timestamp)',
+     "SELECT session, object_id, title, timestamp, nick, "
+     "snippet(messages, '', '', '…', 0, 8) "
+     "FROM messages JOIN sessions ON sessions.id = messages.session "
+     "WHERE messages MATCH ? ORDER BY timestamp DESC LIMIT ?"),
+)
+
+
+class Hit(object):
+    ''' A message of the archive matching a query '''
+
+    __slots__ = ('session', 'object_id', 'title', 'timestamp', 'nick',
+                 'snippet')
+
+    def __init__(self, session, object_id, title, timestamp, nick, snippet):
+        self.session = session
+        self.object_id = object_id
+        self.title = title
+        self.timestamp = timestamp
+        self.nick = nick
+        self.snippet = snippet
+
+
+def open_archive(path):
+    ''' The Archive at path, None if it cannot be opened or SQLite has
+    no full text search '''
+    try:
+        connection = sqlite3.connect(path)
+    except sqlite3.Error as error:
+        logging.warning('Cannot open the chat archive %s: %s', path, error)
+        return None
+    for module, create, query in _MODULES:
+        try:
+            connection.execute(create)
+        except sqlite3.OperationalError:
+            continue
+        logging.debug('Chat archive %s uses %s', path, module)
+        return Archive(connection, query)
+    logging.warning('No full text search in SQLite %s, no chat archive',
+                    sqlite3.sqlite_version)
+    connection.close()
+    return None
+
+
+class Archive(object):
+    ''' The messages of the saved chats.  A chat is a session, named by
+    its activity id. '''
+
+    def __init__(self, connection, query):
+        self._connection = connection
+        self._query = query
+        # The newest archived timestamp of each session
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, '
+            'object_id TEXT, title TEXT, last REAL)')
+        connection.commit()
+
+    def has_session(self, session):
+        ''' Whether session was archived already '''
+        row = self._connection.execute(
+            'SELECT 1 FROM sessions WHERE id = ?', (session, )).fetchone()
+        return row is not None
+
+    def add(self, session, records, object_id=None, title=None):
+        ''' Archive the messages of records, chat.log.Record of session,
+        newer than the ones archived already.  object_id is the journal
+        object of the session, if it has one yet. '''
+        row = self._connection.execute(
+            'SELECT object_id, title, last FROM sessions WHERE id = ?',
+            (session, )).fetchone()
+        if row is None:
+            row = (None, None, None)
+        last = row[2]
+        newest = last
+
+        def messages():
+            # records may stream a whole history: it is not kept
+            nonlocal newest
+            for record in records:
+                if record.is_separator() or \
+                        (last is not None and record.timestamp <= last):
+                    continue
+                if newest is None or record.timestamp > newest:
+                    newest = record.timestamp
+                yield (record.text, record.nick, session, record.timestamp)
+
+        try:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT INTO messages (text, nick, session, timestamp) '
+                    'VALUES (?, ?, ?, ?)', messages())
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                    (session, object_id or row[0], title or row[1], newest))
+        except sqlite3.Error as error:
+            logging.warning('Cannot archive the chat: %s', error)
+
+    def search(self, text, limit=20):
+        ''' The Hits of the messages holding the words of text, in that
+        order, best first '''
+        if not text.strip():
+            return []
+        query = '"%s"' % text.replace('"', '""')
+        try:
+            rows = self._connection.execute(self._query, (query, limit))
+            return [Hit(*row) for row in rows]
+        except sqlite3.Error as error:
+            logging.warning('Cannot search the chat archive: %s', error)
+            return []
+
+    def close(self):
+        self._connection.close()
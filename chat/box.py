@@ -18,16 +18,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import re
 import time
+import bisect
 import logging
-from datetime import datetime
+from itertools import accumulate, chain
+from collections import OrderedDict
 from gettext import gettext as _
 
 from gi.repository import GObject
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Gdk
-from gi.repository import GdkPixbuf
 from gi.repository import Pango
 
 from sugar3.graphics import style
@@ -37,14 +38,31 @@ from sugar3.graphics.palette import MouseSpeedDetector
 from sugar3.util import timestamp_to_elapsed_string
 from sugar3 import profile
 
-from chat import smilies
+from chat.geometry import Geometry
+from chat.history import Spill
+from chat.index import TextIndex
+from chat.log import ChatLog, parse_legacy_timestamp
+from chat import lexer
 from chat.roundbox import RoundBox
 
 
-_URL_REGEXP = re.compile(
-    '((http|ftp)s?://)?'
-    '(([-a-zA-Z0-9]+[.])+[-a-zA-Z0-9]{2,}|([0-9]{1,3}[.]){3}[0-9]{1,3})'
-    '(:[1-9][0-9]{0,4})?(/[-a-zA-Z0-9/%~@&_+=;:,.?#]*[a-zA-Z0-9/])?')
+# Rough size of a line of text, to guess the height of rows that
+# have never been realized
+_LINE_HEIGHT = style.zoom(24)
+_CHAR_WIDTH = style.zoom(10)
+
+# Unrealized bubbles (RoundBox, Gtk.Alignment, Gtk.Grid) kept for reuse
+_SHELL_POOL_SIZE = 32
+
+# URL palettes kept after they have been shown
+_PALETTE_CACHE_SIZE = 8
+
+# Seconds of searching per main loop iteration, see search_async
+_SEARCH_BUDGET = 0.008
+# Records of the saved log read at a time, see ChatBox.load_history
+_HISTORY_PAGE_SIZE = 200
+# Rows kept in memory by default, see ChatBox._evict_rows
+_MAX_ROWS = 1000
 
 
 def _luminance(color):
@@ -75,6 +93,48 @@ def darker_color(colors):
     return 1 - lighter_color(colors)
 
 
+def _create_tag_table(name_color, text_color):
+    ''' The tags of a TextBox buffer '''
+    table = Gtk.TextTagTable()
+    for tag in (
+            Gtk.TextTag(name='name', foreground=name_color.get_html(),
+                        weight=Pango.Weight.BOLD),
+            Gtk.TextTag(name='foreground_color',
+                        foreground=text_color.get_html()),
+            Gtk.TextTag(name='subscript', foreground=text_color.get_html(),
+                        rise=-7 * Pango.SCALE),  # in pixels
+            Gtk.TextTag(name='link', underline=Pango.Underline.SINGLE),
+            # Initialise each TextView object with a default set of
+            # pattern tags
+            Gtk.TextTag(name='pattern-hilite',
+                        background=style.Color('#D80A0A').get_html()),
+            Gtk.TextTag(name='pattern-select',
+                        background=style.Color('#09C3F7').get_html())):
+        table.add(tag)
+    return table
+
+
+class _BubbleStyle(object):
+    ''' Colors of the bubbles of a buddy, and the tags shared by the
+    buffers of these bubbles '''
+
+    __slots__ = ('nick_color', 'text_color', 'color_fill', 'highlight_fill',
+                 '_tag_table')
+
+    def __init__(self, nick_color, text_color, color_fill, highlight_fill):
+        self.nick_color = nick_color
+        self.text_color = text_color
+        self.color_fill = color_fill
+        self.highlight_fill = highlight_fill
+        self._tag_table = None
+
+    def get_tag_table(self):
+        if self._tag_table is None:
+            self._tag_table = _create_tag_table(self.nick_color,
+                                                self.text_color)
+        return self._tag_table
+
+
 class TextBox(Gtk.TextView):
 
     __gsignals__ = {
@@ -84,26 +144,32 @@ class TextBox(Gtk.TextView):
 
     def __init__(self, parent,
                  name_color, text_color, bg_color, highlight_color,
-                 lang_rtl, nick_name=None, text=None):
+                 lang_rtl, nick_name=None, text=None, tag_table=None):
+        ''' tag_table -- Gtk.TextTagTable from _create_tag_table, shared
+        by the TextBoxes of the same colors '''
         Gtk.TextView.__init__(self)
         self._parent = parent
-        self._buffer = Gtk.TextBuffer()
+        if tag_table is None:
+            tag_table = _create_tag_table(name_color, text_color)
+        self._buffer = Gtk.TextBuffer(tag_table=tag_table)
         self._empty_buffer = Gtk.TextBuffer()
         self._empty_buffer.set_text('')
         self._empty = True
-        self._name_tag = self._buffer.create_tag(
-            'name', foreground=name_color.get_html(), weight=Pango.Weight.BOLD)
-        self._fg_tag = self._buffer.create_tag(
-            'foreground_color', foreground=text_color.get_html())
-        self._subscript_tag = self.get_buffer().create_tag(
-            'subscript', foreground=text_color.get_html(),
-            rise=-7 * Pango.SCALE)  # in pixels
-
-        # Initialise each TextView object with a default set of pattern tags
-        self._pattern_tag_hilite = self._buffer.create_tag(
-            'pattern-hilite', background=style.Color('#D80A0A').get_html())
-        self._pattern_tag_select = self._buffer.create_tag(
-            'pattern-select', background=style.Color('#09C3F7').get_html())
+        self._name_tag = tag_table.lookup('name')
+        self._fg_tag = tag_table.lookup('foreground_color')
+        self._subscript_tag = tag_table.lookup('subscript')
+        self._link_tag = tag_table.lookup('link')
+        # Start offsets of the links, in order, and their end offsets
+        # and urls, for bisecting the link under the pointer
+        self._url_starts = []
+        self._urls = []
+        # Tags of the current row, when the TextBox holds the whole
+        # conversation, see add_row
+        self._row_name_tag = self._name_tag
+        self._row_tags = ()
+        # End of the rows being prepended, see begin_prepend
+        self._head = None
+        self._prepend_state = None
         if nick_name:
             self._add_name(nick_name)
             self.add_text(text, newline=False)
@@ -117,7 +183,10 @@ class TextBox(Gtk.TextView):
         self.set_cursor_visible(False)
         self.set_wrap_mode(Gtk.WrapMode.WORD_CHAR)
 
-        self.palette = None
+        # The url of the palette last shown, the palette itself may have
+        # been destroyed since, see ChatBox.get_url_palette
+        self._palette_url = None
+        self._hover_url = None
 
         self._mouse_detector = MouseSpeedDetector(200, 5)
         self._mouse_detector.connect('motion-slow', self.__mouse_slow_cb)
@@ -145,12 +214,14 @@ class TextBox(Gtk.TextView):
     def __size_allocate_cb(self, widget, allocation):
         ''' Load buffer after resize to circumvent race condition '''
         self.set_buffer(self._buffer)
-        self._parent.resize_rb()
+        self._parent.queue_resize_rb()
 
     def resize_box(self):
+        width = self._parent.geometry.text_width
+        if self.get_size_request()[0] == width:
+            return
         self.set_buffer(self._empty_buffer)
-        self.set_size_request(Gdk.Screen.width() - style.GRID_CELL_SIZE -
-                              2 * style.DEFAULT_SPACING, -1)
+        self.set_size_request(width, -1)
 
     def __leave_notify_event_cb(self, widget, event):
         self._mouse_detector.stop()
@@ -162,7 +233,8 @@ class TextBox(Gtk.TextView):
 
     # Links can be activated by clicking.
     def __event_after_cb(self, widget, event):
-        if event.type.value_name != 'GDK_BUTTON_RELEASE':
+        if not self._urls or \
+                event.type.value_name != 'GDK_BUTTON_RELEASE':
             return False
 
         x, y = self.window_to_buffer_coords(Gtk.TextWindowType.WIDGET,
@@ -175,22 +247,28 @@ class TextBox(Gtk.TextView):
 
             iter_tags = iter_tags[1]
 
-        for tag in iter_tags.get_tags():
-            try:
-                url = tag.url
-            except AttributeError:
-                url = None
-            if url is not None:
-                if event.button == 3:
-                    palette = tag.palette
-                    xw, yw = self.get_toplevel().get_pointer()
-                    palette.popup()
-                else:
-                    self._show_via_journal(url)
-                break
+        url = self._get_url_at(iter_tags)
+        if url is not None:
+            if event.button == 3:
+                self._palette_url = url
+                palette = self._parent.get_url_palette(url)
+                xw, yw = self.get_toplevel().get_pointer()
+                palette.popup()
+            else:
+                self._show_via_journal(url)
 
         return False
 
+    def _get_url_at(self, _iter):
+        ''' Return the url of the link at _iter, or None '''
+        offset = _iter.get_offset()
+        index = bisect.bisect_right(self._url_starts, offset) - 1
+        if index >= 0:
+            end, url = self._urls[index]
+            if offset < end:
+                return url
+        return None
+
     def _show_via_journal(self, url):
         self.emit('open-on-journal', url)
 
@@ -200,10 +278,10 @@ class TextBox(Gtk.TextView):
 
         # When check on_slow_mouse event, the position can be out
         # of the widget and return negative values.
-        if x < 0 or y < 0:
+        if x < 0 or y < 0 or not self._urls:
             return False
 
-        self.palette = None
+        self._hover_url = None
         iter_tags = self.get_iter_at_location(x, y)
 
         if Gtk.check_version(3, 19, 8) is None:
@@ -212,16 +290,8 @@ class TextBox(Gtk.TextView):
 
             iter_tags = iter_tags[1]
 
-        tags = iter_tags.get_tags()
-        for tag in tags:
-            try:
-                url = tag.url
-                self.palette = tag.palette
-            except AttributeError:
-                url = None
-            if url is not None:
-                return True
-        return False
+        self._hover_url = self._get_url_at(iter_tags)
+        return self._hover_url is not None
 
     def set_cursor_if_appropriate(self, x, y):
         # Looks at all tags covering the position (x, y) in the text view,
@@ -240,16 +310,27 @@ class TextBox(Gtk.TextView):
         x, y = self.get_pointer()
         hovering_over_link = self.check_url_hovering(x, y)
         if hovering_over_link:
-            if self.palette is not None:
-                xw, yw = self.get_toplevel().get_pointer()
-                self.palette.popup()
-                self._mouse_detector.stop()
+            # The palette is only built when it is about to be shown
+            self._palette_url = self._hover_url
+            palette = self._parent.get_url_palette(self._hover_url)
+            # FIXME: TypeError: _URLMenu: unknown signal name:
+            # enter-notify-event - leave-notify-event
+            # palette.connect('enter-notify-event',
+            #                 self.__palette_mouse_enter_cb)
+            # palette.connect('leave-notify-event',
+            #                 self.__palette_mouse_leave_cb)
+            xw, yw = self.get_toplevel().get_pointer()
+            palette.popup()
+            self._mouse_detector.stop()
         else:
-            if self.palette is not None:
-                self.palette.popdown()
+            if self._palette_url is not None:
+                self._parent.popdown_url_palette(self._palette_url)
 
     # Update the cursor image if the pointer moved.
     def __motion_notify_cb(self, widget, event):
+        if not self._urls:
+            # Nothing to hover
+            return False
         x, y = self.window_to_buffer_coords(Gtk.TextWindowType.WIDGET,
                                             int(event.x), int(event.y))
         self.set_cursor_if_appropriate(x, y)
@@ -259,6 +340,8 @@ class TextBox(Gtk.TextView):
     def __visibility_notify_cb(self, widget, event):
         # Also update the cursor image if the window becomes visible
         # (e.g. when a window covering it got iconified).
+        if not self._urls:
+            return False
         bx, by = self.window_to_buffer_coords(
             Gtk.TextWindowType.WIDGET, 200, 200)
         self.set_cursor_if_appropriate(bx, by)
@@ -270,79 +353,242 @@ class TextBox(Gtk.TextView):
     def __palette_mouse_leave_cb(self, widget, event):
         self.handler_unblock(self.motion_notify_id)
 
+    def add_row(self, nick_name, text, name_tag, tags):
+        ''' Start a new paragraph of the conversation, for a ChatBox
+        rendering all its rows in one buffer.  Text added until the
+        next row gets tags on top of the TextBox ones.
+        Returns a mark at the start of the row. '''
+        buf = self._buffer
+        if not self._empty:
+            buf.insert_with_tags(self._get_end(), '\n', *self._row_tags)
+        mark = buf.create_mark(None, self._get_end(), True)
+        self._empty = True
+        self._row_name_tag = name_tag
+        self._row_tags = tags
+        if nick_name:
+            self._add_name(nick_name)
+            self.add_text(text, newline=False)
+        elif text:
+            self.add_text(text)
+        return mark
+
+    def begin_prepend(self):
+        ''' Add the rows added until end_prepend before the others '''
+        buf = self._buffer
+        self._head = buf.create_mark(None, buf.get_start_iter(), False)
+        self._prepend_state = (self._empty, self._row_name_tag,
+                               self._row_tags, self._url_starts, self._urls)
+        self._empty = True
+        self._url_starts = []
+        self._urls = []
+
+    def end_prepend(self):
+        ''' Returns the length of the text added since begin_prepend,
+        where the rows that were first now start '''
+        buf = self._buffer
+        empty, name_tag, tags, url_starts, urls = self._prepend_state
+        self._prepend_state = None
+        if not empty:
+            if not self._empty:
+                buf.insert_with_tags(self._get_end(), '\n',
+                                     *self._row_tags)
+            # The last row is still the last one
+            self._empty = False
+            self._row_name_tag = name_tag
+            self._row_tags = tags
+        length = buf.get_iter_at_mark(self._head).get_offset()
+        buf.delete_mark(self._head)
+        self._head = None
+        self._url_starts.extend(start + length for start in url_starts)
+        self._urls.extend((end + length, url) for end, url in urls)
+        return length
+
+    def remove_head(self, mark):
+        ''' Remove the rows before the one starting at mark '''
+        buf = self._buffer
+        end = buf.get_iter_at_mark(mark)
+        length = end.get_offset()
+        buf.delete(buf.get_start_iter(), end)
+        index = bisect.bisect_left(self._url_starts, length)
+        self._url_starts = [start - length
+                            for start in self._url_starts[index:]]
+        self._urls = [(end - length, url) for end, url in self._urls[index:]]
+
+    def _get_end(self):
+        ''' Where text is added: the end of the buffer, or of the rows
+        being prepended '''
+        if self._head is None:
+            return self._buffer.get_end_iter()
+        return self._buffer.get_iter_at_mark(self._head)
+
     def _add_name(self, name):
         buf = self._buffer
-        self.iter_text = self._buffer.get_iter_at_offset(0)
-        words = name.split()
-        for word in words:
-            buf.insert_with_tags(self.iter_text, word, self._name_tag)
-            buf.insert_with_tags(self.iter_text, ' ', self._fg_tag)
+        self.iter_text = self._get_end()
+        buf.insert_with_tags(self.iter_text, ' '.join(name.split()),
+                             self._name_tag, self._row_name_tag,
+                             *self._row_tags)
+        buf.insert_with_tags(self.iter_text, ' ', self._fg_tag,
+                             *self._row_tags)
 
         self._empty = False
 
     def add_text(self, text, newline=True):
         buf = self._buffer
-        self.iter_text = self._buffer.get_end_iter()
+        self.iter_text = self._get_end()
 
         if not self._empty:
             if newline:
-                buf.insert(self.iter_text, '\n')
+                buf.insert_with_tags(self.iter_text, '\n', *self._row_tags)
             else:
-                buf.insert(self.iter_text, ' ')
-
-        words = text.split()
-        for word in words:
-            if _URL_REGEXP.match(word) is not None:
-                tag = buf.create_tag(None, underline=Pango.Underline.SINGLE)
-                tag.url = word
-                palette = _URLMenu(word)
-                # FIXME: TypeError: _URLMenu: unknown signal name:
-                # enter-notify-event - leave-notify-event
-                # palette.connect('enter-notify-event',
-                #                 self.__palette_mouse_enter_cb)
-                # palette.connect('leave-notify-event',
-                #                 self.__palette_mouse_leave_cb)
-                tag.palette = palette
-                buf.insert_with_tags(self.iter_text, word, tag, self._fg_tag)
-            else:
-                for i in smilies.parse(word):
-                    if isinstance(i, GdkPixbuf.Pixbuf):
-                        start = self.iter_text.get_offset()
-                        buf.insert_pixbuf(self.iter_text, i)
-                        buf.apply_tag(self._subscript_tag,
-                                      buf.get_iter_at_offset(start),
-                                      self.iter_text)
-                    else:
-                        buf.insert_with_tags(self.iter_text, i, self._fg_tag)
-            buf.insert_with_tags(self.iter_text, ' ', self._fg_tag)
+                buf.insert_with_tags(self.iter_text, ' ', *self._row_tags)
+
+        for kind, value in self._parent.lexer.lex(text):
+            self._insert_run(kind, value)
 
         self._empty = False
 
+    def _insert_run(self, kind, value):
+        buf = self._buffer
+        if kind == lexer.RUN_URL:
+            start = self.iter_text.get_offset()
+            # Text is only ever appended, or prepended in a new list,
+            # see begin_prepend, so the links stay sorted
+            self._url_starts.append(start)
+            self._urls.append((start + len(value), value))
+            buf.insert_with_tags(self.iter_text, value, self._link_tag,
+                                 self._fg_tag, *self._row_tags)
+        elif kind == lexer.RUN_SMILEY:
+            start = self.iter_text.get_offset()
+            buf.insert_pixbuf(self.iter_text, value)
+            for tag in (self._subscript_tag,) + self._row_tags:
+                buf.apply_tag(tag, buf.get_iter_at_offset(start),
+                              self.iter_text)
+        else:
+            buf.insert_with_tags(self.iter_text, value, self._fg_tag,
+                                 *self._row_tags)
+
     def get_buffer(self):
         return self._buffer
 
 
+def _is_me_message(text):
+    return len(text) > 3 and text[0:4] == '/me '
+
+
+class _Row(object):
+    ''' A bubble (or a separator) of the conversation.  Rows are kept
+    for the whole conversation, but only the ones near the viewport
+    have widgets. '''
+
+    __slots__ = ('buddy', 'nick', 'texts', 'text', 'style', 'tail',
+                 'lang_rtl', 'is_separator', 'records', 'height', 'widget',
+                 'textbox', 'mark')
+
+    def __init__(self, buddy, nick, text, bubble_style, tail=None,
+                 lang_rtl=False, is_separator=False):
+        self.buddy = buddy
+        self.nick = nick
+        self.texts = [text]
+        # Text of the TextBox buffer, see ChatBox._get_row_text
+        self.text = None
+        self.style = bubble_style
+        self.tail = tail
+        self.lang_rtl = lang_rtl
+        self.is_separator = is_separator
+        # Log records from the one of the row to the one of the next row
+        self.records = 1
+        # Allocated height, None until the row has been realized
+        self.height = None
+        self.widget = None
+        self.textbox = None
+        # Start of the row in a single buffer conversation
+        self.mark = None
+
+
 class ChatBox(Gtk.ScrolledWindow):
 
     __gsignals__ = {
         'foo': (GObject.SignalFlags.RUN_FIRST, None, ([])),
         'open-on-journal': (GObject.SignalFlags.RUN_FIRST, None, ([str])),
-        'new-message': (GObject.SignalFlags.RUN_FIRST, None, ([]))
+        'new-message': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+        'search-updated': (GObject.SignalFlags.RUN_FIRST, None, ([]))
     }
 
-    def __init__(self, owner):
+    def __init__(self, owner, single_buffer=False, geometry=None,
+                 spill_path=None, max_rows=_MAX_ROWS):
+        ''' single_buffer -- boolean
+        False: one bubble widget per row near the viewport
+        True: the whole conversation in memory in one TextView,
+        bubbles being paragraph backgrounds
+        geometry -- Geometry shared with the activity, if any
+        spill_path -- file for the rows past max_rows, None to keep
+        every row in memory
+        '''
         Gtk.ScrolledWindow.__init__(self)
 
         self._owner = owner
 
+        if geometry is None:
+            geometry = Geometry()
+        self.geometry = geometry
+        self.geometry.connect('changed', self.__geometry_changed_cb)
+
         # Auto vs manual scrolling:
         self._scroll_auto = True
         self._scroll_value = 0.0
         self._last_msg_sender = None
         # Track last message, to combine several messages:
         self._last_msg = None
-        self._chat_log = ''
-        self._row_counter = 0
+        # Every message and separator, for the journal
+        self.log = ChatLog()
+        # Log records before the one of the first row
+        self._log_head = 0
+        # Older records of the saved log, see load_history
+        self.history = None
+        self._history_id = None
+        # Source and offset of the newest older record matching
+        # search_text, None until searched, see _get_older_match
+        self._older_match = None
+        self._older_search = None
+        self._older_id = None
+        # Records of the rows removed from memory, newer than the ones
+        # of history, see _evict_rows
+        if spill_path is None:
+            self._spill = None
+        else:
+            self._spill = Spill(spill_path)
+        self._max_rows = max_rows
+
+        # Splits messages into runs, caching words for all the messages
+        self.lexer = lexer.Lexer()
+
+        # Recently shown _URLMenu of each url, oldest first
+        self._palettes = OrderedDict()
+
+        # _BubbleStyle of each buddy color, None for status messages
+        self._styles = {}
+        self._separator_style = _BubbleStyle(
+            style.COLOR_BUTTON_GREY, style.COLOR_BUTTON_GREY,
+            style.COLOR_WHITE, style.COLOR_BUTTON_GREY)
+
+        # Every row of the conversation.  Rows first to last - 1 are
+        # realized, the others are stood for by two spacers.
+        self._rows = []
+        self._first = 0
+        self._last = 0
+        # offsets[i] is the y position of row i, estimated for the
+        # rows that have never been realized
+        self._offsets = [0]
+        self._offsets_dirty = False
+        # Row index and distance to it of the top of the viewport
+        self._anchor = None
+        self._update_id = None
+        # Unused RoundBox, Gtk.Alignment and Gtk.Grid stacks
+        self._shells = []
+        # Width of the bubbles, and size of the conversation, last set
+        self._rb_width = None
+        self._conversation_size = None
+        self._resize_id = None
 
         # We need access to individual messages for resizing
         # TODO: use a signal for this
@@ -350,29 +596,76 @@ class ChatBox(Gtk.ScrolledWindow):
         self._grid_list = []
         self._message_list = []
 
-        self._conversation = Gtk.Grid()
-        self._conversation.set_row_spacing(style.DEFAULT_PADDING)
-        self._conversation.set_border_width(0)
-        self._conversation.set_size_request(
-            Gdk.Screen.width() - style.GRID_CELL_SIZE, -1)
-
         self.search_text = ''
 
-        # A TextMark start object, a TextMark end object and block index number
+        # Start offset, end offset and row index of the selected match
         self.highlight_text = (None, None, None)
 
+        # Trigrams of the row texts, see _get_row_text, for the first
+        # indexed rows, the others being indexed while idle
+        self._index = TextIndex()
+        self._indexed = 0
+        self._index_id = None
+        # Whether a saved log is being added, see replay
+        self._replaying = False
+        # Start offsets of the matches of search_text in each row
+        self._hits = {}
+        # (row index, start offset, end offset) of every match in
+        # order, and the position of the selected one in it
+        self._matches = []
+        self._cursor = None
+        # Candidate rows not searched yet, and the first row to search
+        # in full once they are, see _search_chunk
+        self._pending = None
+        self._search_end = 0
+        self._search_id = None
+        # Match start offsets, selected match start offset and match
+        # length tagged in each realized row
+        self._tagged = {}
+
         # OSK padding for conversation
         self._dy = 0
 
-        evbox = Gtk.EventBox()
-        evbox.modify_bg(
-            Gtk.StateType.NORMAL, style.COLOR_WHITE.get_gdk_color())
-        evbox.add(self._conversation)
-        self._conversation.show()
-
         self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.ALWAYS)
-        self.add_with_viewport(evbox)
-        evbox.show()
+
+        if single_buffer:
+            self._view = TextBox(self, style.COLOR_BLACK, style.COLOR_BLACK,
+                                 style.COLOR_WHITE, style.COLOR_BUTTON_GREY,
+                                 False)
+            self._view.set_border_width(style.DEFAULT_PADDING)
+            self._view.connect('open-on-journal', self.__open_on_journal)
+            self._message_list.append(self._view)
+            # Name tag and text tags of each color scheme, see
+            # _get_row_tags
+            self._row_tags = {}
+            self._conversation = None
+            self.add(self._view)
+            self._view.show()
+        else:
+            self._view = None
+            self._conversation = Gtk.Box(
+                orientation=Gtk.Orientation.VERTICAL,
+                spacing=style.DEFAULT_PADDING)
+            self._conversation.set_border_width(0)
+            self._conversation.set_size_request(
+                self.geometry.bubble_width, -1)
+
+            self._top_spacer = Gtk.Box()
+            self._conversation.pack_start(self._top_spacer, False, False, 0)
+            self._top_spacer.show()
+            self._bottom_spacer = Gtk.Box()
+            self._conversation.pack_start(
+                self._bottom_spacer, False, False, 0)
+            self._bottom_spacer.show()
+
+            evbox = Gtk.EventBox()
+            evbox.modify_bg(
+                Gtk.StateType.NORMAL, style.COLOR_WHITE.get_gdk_color())
+            evbox.add(self._conversation)
+            self._conversation.show()
+
+            self.add_with_viewport(evbox)
+            evbox.show()
 
         vadj = self.get_vadjustment()
         vadj.connect('changed', self._scroll_changed_cb)
@@ -380,190 +673,348 @@ class ChatBox(Gtk.ScrolledWindow):
 
         self.connect('foo', self.resize_rb)
 
+    def _get_row_text(self, row):
+        ''' The text of the row TextBox buffer, with U+FFFC standing for
+        each smiley, so that offsets in both match. '''
+        if row.text is None:
+            chunks = []
+            empty = True
+            for index, text in enumerate(row.texts):
+                if index == 0:
+                    if row.nick:
+                        # TextBox._add_name, then a space
+                        chunks.append(' '.join(row.nick.split()) + '  ')
+                        empty = False
+                    elif not text:
+                        continue
+                elif not empty:
+                    chunks.append('\n')
+                chunks.append(lexer.get_text(self.lexer.lex(text)))
+                empty = False
+            row.text = ''.join(chunks)
+        return row.text
+
     def set_search_text(self, text):
+        ''' Find and tag the matches of text, all at once '''
+        self._begin_search(text)
+        self._search_chunk(None)
+
+    def search_async(self, text):
+        ''' Find and tag the matches of text, a slice of the conversation
+        per main loop iteration.  search-updated is emitted as matches
+        are found.  A new search cancels the pending one. '''
+        self._begin_search(text)
+        self._search_id = GLib.idle_add(self._search_chunk, _SEARCH_BUDGET)
+
+    def is_searching(self):
+        return self._pending is not None
+
+    def get_match_count(self):
+        return len(self._matches)
+
+    def _begin_search(self, text):
+        if self._search_id is not None:
+            GLib.source_remove(self._search_id)
+            self._search_id = None
         self.search_text = text
-        count = 0
-        for textbox_count in range(0, len(self._message_list)):
-            _buffer = self._message_list[textbox_count].get_buffer()
-            start, end = _buffer.get_bounds()
-            _buffer.remove_tag_by_name('pattern-hilite', start, end)
-            _buffer.remove_tag_by_name('pattern-select', start, end)
-
-            text_iter = _buffer.get_start_iter()
-
-            if self.search_text != '':
-                while True:
-                    next_found = text_iter.forward_search(
-                        self.search_text,
-                        Gtk.TextSearchFlags.VISIBLE_ONLY |
-                        Gtk.TextSearchFlags.TEXT_ONLY,
-                        None)
-                    if next_found is None:
-                        break
-                    count += 1
-                    start, end = next_found
-                    if count == 1 and self.highlight_text[2] is None:
-                        # Create marks
-                        start_mark = \
-                            _buffer.create_mark('start', start,
-                                                left_gravity=True)
-                        end_mark = \
-                            _buffer.create_mark('end', end,
-                                                left_gravity=True)
-                        self.highlight_text = \
-                            (start_mark, end_mark, textbox_count)
-                        _buffer.apply_tag_by_name('pattern-select', start, end)
-                    _buffer.apply_tag_by_name('pattern-hilite', start, end)
-                    text_iter = end
+        self._hits = {}
+        self._matches = []
+        self._forget_older_match()
+        self._select(None)
+        candidates = []
+        if self.search_text != '':
+            candidates = self._index.candidates(self.search_text)
+            if candidates is None:
+                candidates = range(len(self._rows))
+            else:
+                candidates = chain(
+                    candidates, range(self._indexed, len(self._rows)))
+        self._pending = iter(candidates)
+        self._search_end = len(self._rows)
+
+    def _search_chunk(self, budget):
+        ''' Search the pending rows for budget seconds, or until done if
+        budget is None.  Returns True if there are rows left. '''
+        if budget is not None:
+            deadline = time.time() + budget
+        for i in self._pending:
+            if i >= self._search_end:
+                # Rows changed meanwhile are searched at the end
+                break
+            self._find_in_row(i)
+            if i in self._hits:
+                if self._cursor is None:
+                    self._select(0)
+                self._highlight_row(i)
+            if budget is not None and time.time() > deadline:
+                self.emit('search-updated')
+                return True
+
+        if self.search_text != '':
+            for i in range(self._search_end, len(self._rows)):
+                self._find_in_row(i)
+            if self._cursor is None and self._matches:
+                self._select(0)
+        self._pending = None
+        self._search_id = None
+
+        # Only the rows whose matches changed are retagged
+        for i in set(self._tagged).union(self._hits):
+            self._highlight_row(i)
+        self.emit('search-updated')
+        return False
+
+    def _find_in_row(self, i, start=0):
+        ''' Update the matches of search_text in the row at index i,
+        which is after any other row with matches, from offset start.
+        The matches before start are kept. '''
+        text = self._get_row_text(self._rows[i])
+        length = len(self.search_text)
+        if start == 0:
+            while self._matches and self._matches[-1][0] == i:
+                self._matches.pop()
+            starts = []
+        else:
+            starts = self._hits.get(i, [])
+        start = text.find(self.search_text, start)
+        while start >= 0:
+            starts.append(start)
+            self._matches.append((i, start, start + length))
+            start = text.find(self.search_text, start + length)
+        if starts:
+            self._hits[i] = starts
+        else:
+            self._hits.pop(i, None)
+
+    def _select(self, cursor):
+        ''' Make the match at cursor in the match table the selected one
+        '''
+        self._cursor = cursor
+        if cursor is None:
+            self.highlight_text = (None, None, None)
+        else:
+            i, start, end = self._matches[cursor]
+            self.highlight_text = (start, end, i)
+
+    def _get_row_offset(self, row):
+        ''' Offset of the realized row in its buffer '''
+        if row.mark is None:
+            return 0
+        return row.textbox.get_buffer().get_iter_at_mark(
+            row.mark).get_offset()
+
+    def _highlight_row(self, index):
+        ''' Tag the matches of the realized row at index, unless they
+        already are '''
+        if index is None or self._rows[index].textbox is None:
+            return
+        start, end, current_index = self.highlight_text
+        if current_index != index:
+            start = None
+        length = len(self.search_text)
+        tagged = (tuple(self._hits.get(index, ())), start, length)
+        previous = self._tagged.get(index, ((), None, length))
+        if previous == tagged:
+            return
+
+        row = self._rows[index]
+        _buffer = row.textbox.get_buffer()
+        base = self._get_row_offset(row)
+        if previous[0] == tagged[0] and previous[2] == length:
+            # Only the selection moved
+            start = previous[1]
+            if start is not None:
+                _buffer.remove_tag_by_name(
+                    'pattern-select', _buffer.get_iter_at_offset(base + start),
+                    _buffer.get_iter_at_offset(base + start + length))
+            start = tagged[1]
+            if start is not None:
+                _buffer.apply_tag_by_name(
+                    'pattern-select', _buffer.get_iter_at_offset(base + start),
+                    _buffer.get_iter_at_offset(base + start + length))
+            self._tagged[index] = tagged
+            return
+
+        _buffer.remove_tag_by_name(
+            'pattern-hilite', _buffer.get_iter_at_offset(base),
+            _buffer.get_iter_at_offset(base + len(self._get_row_text(row))))
+        _buffer.remove_tag_by_name(
+            'pattern-select', _buffer.get_iter_at_offset(base),
+            _buffer.get_iter_at_offset(base + len(self._get_row_text(row))))
+
+        for start in tagged[0]:
+            _buffer.apply_tag_by_name(
+                'pattern-hilite', _buffer.get_iter_at_offset(base + start),
+                _buffer.get_iter_at_offset(base + start + length))
+        start = tagged[1]
+        if start is not None:
+            _buffer.apply_tag_by_name(
+                'pattern-select', _buffer.get_iter_at_offset(base + start),
+                _buffer.get_iter_at_offset(base + start + length))
+
+        if tagged[:2] == ((), None):
+            self._tagged.pop(index, None)
+        else:
+            self._tagged[index] = tagged
 
     def check_next(self, direction):
-        current_index = self.highlight_text[2]
-        if current_index is not None:
-            if direction == 'forward':
-                for i in range(current_index, len(self._message_list)):
-                    _buffer = self._message_list[i].get_buffer()
-                    if i == current_index:
-                        # End iter
-                        text_iter = \
-                            _buffer.get_iter_at_mark(
-                                self.highlight_text[1])
-                    else:
-                        text_iter = _buffer.get_start_iter()
-                    next_exists = \
-                        text_iter.forward_to_tag_toggle(
-                            self._message_list[i]._pattern_tag_hilite)
-                    if next_exists:
-                        return True
-                return False
-            elif direction == 'backward':
-                for i in range(current_index, -1, -1):
-                    _buffer = self._message_list[i].get_buffer()
-                    if i == current_index:
-                        # Start iter
-                        text_iter = \
-                            _buffer.get_iter_at_mark(
-                                self.highlight_text[0])
-                    else:
-                        text_iter = _buffer.get_end_iter()
-                    prev_exists = \
-                        text_iter.backward_to_tag_toggle(
-                            self._message_list[i]._pattern_tag_hilite)
-                    if prev_exists:
-                        return True
-                return False
-            else:
+        if direction == 'forward':
+            return self._cursor is not None and \
+                self._cursor + 1 < len(self._matches)
+        elif direction == 'backward':
+            if self._cursor:
+                return True
+            # There may be matches in the records not in memory
+            if self.search_text == '':
                 return False
+            match = self._get_older_match()
+            return match is not None and match[0] is not None
+        return False
 
     def get_next_result(self, direction):
-        current_index = self.highlight_text[2]
-        if current_index is not None:
-            if direction == 'forward':
-                for i in range(current_index, len(self._message_list)):
-                    _buffer = self._message_list[i].get_buffer()
-                    if i == current_index:
-                        # End iter
-                        text_iter = \
-                            _buffer.get_iter_at_mark(self.highlight_text[1])
-                    else:
-                        text_iter = _buffer.get_start_iter()
-
-                    _temp = text_iter \
-                        .forward_search(self.search_text,
-                                        Gtk.TextSearchFlags.VISIBLE_ONLY |
-                                        Gtk.TextSearchFlags.TEXT_ONLY,
-                                        None)
-                    if _temp is not None:
-                        start, end = _temp
-                        if i == current_index:
-                            _buffer.move_mark_by_name('start', start)
-                            _buffer.move_mark_by_name('end', end)
-                        else:
-                            start_mark = _buffer.create_mark('start', start,
-                                                             left_gravity=True)
-                            end_mark = _buffer.create_mark('end', end,
-                                                           left_gravity=True)
-                            self.highlight_text = \
-                                (start_mark, end_mark, i)
-                        return _temp
-                    else:
-                        if i == current_index:
-                            _buffer.delete_mark_by_name('start')
-                            _buffer.delete_mark_by_name('end')
-                return None
-            elif direction == 'backward':
-                for i in range(current_index, -1, -1):
-                    _buffer = self._message_list[i].get_buffer()
-                    if i == current_index:
-                        # Start iter
-                        text_iter = \
-                            _buffer.get_iter_at_mark(
-                                self.highlight_text[0])
-                    else:
-                        text_iter = _buffer.get_end_iter()
-
-                    _temp = text_iter \
-                        .backward_search(self.search_text,
-                                         Gtk.TextSearchFlags.VISIBLE_ONLY |
-                                         Gtk.TextSearchFlags.TEXT_ONLY,
-                                         None)
-                    if _temp is not None:
-                        start, end = _temp
-                        if i == current_index:
-                            _buffer.move_mark_by_name('start', start)
-                            _buffer.move_mark_by_name('end', end)
-                        else:
-                            start_mark = _buffer.create_mark('start', start,
-                                                             left_gravity=True)
-                            end_mark = \
-                                _buffer.create_mark('end', end,
-                                                    left_gravity=True)
-                            self.highlight_text = \
-                                (start_mark, end_mark, i)
-                        return _temp
-                    else:
-                        if i == current_index:
-                            _buffer.delete_mark_by_name('start')
-                            _buffer.delete_mark_by_name('end')
-                return None
-        else:
+        ''' Select the next match in direction, loading the older
+        records up to the newest match if needed.
+        Returns (row index, start offset, end offset) or None. '''
+        if not self.check_next(direction):
             return None
+        if direction == 'forward':
+            self._select(self._cursor + 1)
+        elif self._cursor:
+            self._select(self._cursor - 1)
+        else:
+            cursor = self._cursor
+            if not self._load_match():
+                return None
+            if cursor is None:
+                self._select(len(self._matches) - 1)
+            else:
+                self._select(self._cursor - 1)
+        return self._matches[self._cursor]
+
+    def _get_older_match(self):
+        ''' The source of the newest record before the first row whose
+        row would match search_text, and the offset of the record in it,
+        or (None, None).  None while the records are searched on disk, a
+        slice per main loop iteration, until search-updated is emitted.
+        Nothing is loaded. '''
+        if self._older_match is None and self._older_id is None:
+            self._older_search = self._search_older()
+            self._older_id = GLib.idle_add(self.__older_idle_cb)
+        return self._older_match
+
+    def _search_older(self):
+        ''' Yield None while searching, then the older match '''
+        for source in (self._spill, self.history):
+            if source is not None and source.has_more():
+                for offset in source.find(self.search_text,
+                                          self._record_matches):
+                    if offset is not None:
+                        yield source, offset
+                        return
+                    yield None
+        yield None, None
+
+    def __older_idle_cb(self):
+        deadline = time.time() + _SEARCH_BUDGET
+        for match in self._older_search:
+            if match is not None:
+                break
+            if time.time() > deadline:
+                return True
+        self._older_match = match
+        self._older_search = None
+        self._older_id = None
+        self.emit('search-updated')
+        return False
+
+    def _forget_older_match(self):
+        if self._older_id is not None:
+            GLib.source_remove(self._older_id)
+            self._older_id = None
+        self._older_search = None
+        self._older_match = None
+
+    def _record_matches(self, record):
+        ''' Whether the row of record, see _new_row, matches search_text
+        '''
+        if record.is_separator():
+            return False
+        text = record.text
+        if _is_me_message(text):
+            text = text[4:]
+        if not record.status and \
+                self.search_text in ' '.join(record.nick.split()):
+            return True
+        return self.search_text in lexer.get_text(self.lexer.lex(text))
+
+    def _load_match(self):
+        ''' Prepend the older records up to the newest one with a match,
+        if there is one.  Returns the number of matches found. '''
+        if self._search_id is not None:
+            GLib.source_remove(self._search_id)
+            self._search_chunk(None)
+        count = len(self._matches)
+        # Found by check_next
+        source, offset = self._older_match
+        if source is not None:
+            records = source.read_to(offset)
+            if source is not self._spill and self._spill is not None:
+                # The spilled records are newer than the ones of history
+                records.extend(self._spill.read_page())
+            self._prepend_records(records)
+        return len(self._matches) - count
 
     def search(self, direction):
+        previous_index = self.highlight_text[2]
+        count = len(self._rows)
         next_found = self.get_next_result(direction)
         if next_found:
-            current_search_index = self.highlight_text[2]
-            _buffer = \
-                self._message_list[current_search_index].get_buffer()
-
-            for count in range(0, len(self._message_list)):
-                temp_buf = self._message_list[count].get_buffer()
-                t_start, t_end = temp_buf.get_bounds()
-                temp_buf.remove_tag_by_name('pattern-select', t_start, t_end)
-
-            start, end = next_found
-            _buffer.apply_tag_by_name('pattern-select', start, end)
-            _buffer.place_cursor(start)
-
-            self._message_list[current_search_index] \
-                .scroll_to_iter(start, 0.1, use_align=False,
-                                xalign=0.0, yalign=0.0)
-            self._message_list[current_search_index] \
-                .scroll_to_iter(end, 0.1, use_align=False,
-                                xalign=0.0, yalign=0.0)
-
-    def get_textbox(self, textbox_count):
-        return self._message_list[textbox_count]
+            index, start, end = next_found
+            if previous_index is not None:
+                # Rows may have been loaded above, see _load_match
+                previous_index += len(self._rows) - count
+            self._highlight_row(previous_index)
+            if index != previous_index:
+                self._highlight_row(index)
+            self._scroll_to_row(index, start)
+
+    def _scroll_to_row(self, index, offset=0):
+        ''' Scroll so that offset in the row at index is visible '''
+        self._scroll_auto = False
+        row = self._rows[index]
+        if self._view is not None:
+            value = 0
+        else:
+            value = self._get_offsets()[index]
+        if row.textbox is not None:
+            _buffer = row.textbox.get_buffer()
+            value += row.textbox.get_iter_location(_buffer.get_iter_at_offset(
+                self._get_row_offset(row) + offset)).y
 
-    def number_of_textboxes(self):
-        return len(self._message_list)
+        vadj = self.get_vadjustment()
+        vadj.set_value(max(0, value - vadj.get_page_size() / 3))
+
+    def get_url_palette(self, url):
+        ''' The _URLMenu of url, built on first use '''
+        palette = self._palettes.pop(url, None)
+        if palette is None:
+            palette = _URLMenu(url)
+            if len(self._palettes) >= _PALETTE_CACHE_SIZE:
+                url_, oldest = self._palettes.popitem(last=False)
+                oldest.destroy()
+        self._palettes[url] = palette
+        return palette
+
+    def popdown_url_palette(self, url):
+        ''' Hide the _URLMenu of url, if it is still kept '''
+        palette = self._palettes.get(url)
+        if palette is not None:
+            palette.popdown()
 
     def __open_on_journal(self, widget, url):
         self.emit('open-on-journal', url)
 
-    def get_log(self):
-        return self._chat_log
-
-    def add_text(self, buddy, text, status_message=False):
+    def add_text(self, buddy, text, status_message=False, timestamp=None):
         '''Display text on screen, with name and colors.
         buddy -- buddy object or dict {nick: string, color: string}
         (The dict is for loading the chat log from the journal,
@@ -572,6 +1023,7 @@ class ChatBox(Gtk.ScrolledWindow):
         status_message -- boolean
         False: show what buddy said
         True: show what buddy did
+        timestamp -- seconds since the epoch, for the log, now if None
 
         .----- rb ------------.
         |  +----align-------+ |
@@ -582,7 +1034,7 @@ class ChatBox(Gtk.ScrolledWindow):
         |  | +------------+ | |
         |  +----------------+ |
         `----------------- +--'
-                          \|
+                          \\|
 
         The color scheme for owner messages is:
         nick in lighter of stroke and fill colors
@@ -596,6 +1048,10 @@ class ChatBox(Gtk.ScrolledWindow):
 
         rb has a tail on the right for owner messages and the left for
         buddy messages.
+
+        Only the rows near the viewport get these widgets, see
+        _update_window.  In single buffer mode, rows are paragraphs
+        of one TextView instead, see _render_row.
         '''
         if not buddy:
             buddy = self._owner
@@ -607,183 +1063,681 @@ class ChatBox(Gtk.ScrolledWindow):
         else:
             nick = buddy.props.nick
             color = buddy.props.color
-        try:
-            color_stroke_html, color_fill_html = color.split(',')
-        except ValueError:
-            color_stroke_html, color_fill_html = ('#000000', '#888888')
 
-        lighter = lighter_color(color.split(','))
-        darker = 1 - lighter
+        self.log.append(nick, color, text, status_message, timestamp)
 
-        if len(text) > 3 and text[0:4] == '/me ':
-            me_message = True
+        # Check if new message box or add text to previous:
+        if self._last_msg_sender and buddy == self._last_msg_sender and \
+                not (status_message or _is_me_message(text)):
+            # The last message is the last row, as separators and
+            # status messages reset _last_msg_sender
+            row = self._last_msg
+            row.texts.append(text)
+            row.records += 1
+            if row.text is None:
+                # Neither indexed nor searched yet
+                length = 0
+            else:
+                # Extend the text, see _get_row_text, rather than lexing
+                # the whole row again
+                length = len(row.text)
+                if row.text:
+                    row.text += '\n'
+                row.text += lexer.get_text(self.lexer.lex(text))
+            if row.textbox is not None:
+                row.textbox.add_text(text)
+            else:
+                row.height = None
+            self._offsets_dirty = True
+            self._update_row(len(self._rows) - 1, length)
         else:
-            me_message = False
+            row = self._new_row(buddy, nick, color, text, status_message)
+            self._append_row(row)
+
+            self._last_msg_sender = buddy
+            self._last_msg = row
+
+        if status_message:
+            self._last_msg_sender = None
+
+        if not self._replaying:
+            self.emit("new-message")
 
+    def replay(self, records):
+        '''Add records, chat.log.Record, oldest first.
+        new-message is not emitted, and the search index is only built
+        afterwards, while idle.  The rows near the bottom of the
+        conversation are the first to be realized.'''
+        self._replaying = True
+        last_was_separator = False
+        try:
+            for record in records:
+                if record.is_separator():
+                    if not last_was_separator:
+                        self.add_separator(record.timestamp)
+                        last_was_separator = True
+                else:
+                    self.add_text(
+                        {'nick': record.nick, 'color': record.color},
+                        record.text, record.status, record.timestamp)
+                    last_was_separator = False
+        finally:
+            self._replaying = False
+
+        self._queue_indexing()
+        if self.search_text != '':
+            self.search_async(self.search_text)
+
+    def _new_row(self, buddy, nick, color, text, status_message):
+        ''' The row of a message, see add_text '''
+        me_message = _is_me_message(text)
         if status_message or me_message:
-            text_color = style.COLOR_WHITE
-            nick_color = style.COLOR_WHITE
-            color_fill = style.Color('#808080')
-            highlight_fill = style.COLOR_WHITE
+            bubble_style = self._get_style(None)
             tail = None
         else:
-            highlight_fill = style.COLOR_BUTTON_GREY
-            if is_dark_too_light(color.split(',')[darker]):
-                text_color = style.COLOR_BLACK
-                darker = lighter  # use black on lighter of the two colors
-            else:
-                text_color = style.COLOR_WHITE
-            if darker == 0:
-                color_fill = style.Color(color_stroke_html)
-                if is_low_contrast(color.split(',')):
-                    nick_color = text_color
-                else:
-                    nick_color = style.Color(color_fill_html)
-            else:
-                color_fill = style.Color(color_fill_html)
-                if is_low_contrast(color.split(',')):
-                    nick_color = text_color
-                else:
-                    nick_color = style.Color(color_stroke_html)
+            bubble_style = self._get_style(color)
             if nick == profile.get_nick_name():
                 tail = 'right'
             else:
                 tail = 'left'
 
-        color_stroke = None
-
-        self._add_log(nick, color, text, status_message)
-
         # Check for Right-To-Left languages:
         if Pango.find_base_dir(nick, -1) == Pango.Direction.RTL:
             lang_rtl = True
         else:
             lang_rtl = False
 
-        # Check if new message box or add text to previous:
-        new_msg = True
-        if self._last_msg_sender and buddy == self._last_msg_sender:
-            # Add text to previous message
-            if not (me_message or status_message):
-                new_msg = False
-
-        if not new_msg:
-            message = self._last_msg
-            message.add_text(text)
-        else:
-            rb = RoundBox()
-            rb.background_color = color_fill
-            rb.border_color = color_stroke
-            rb.tail = tail
-            self._rb_list.append(rb)
-
-            grid_internal = Gtk.Grid()
-            grid_internal.set_row_spacing(0)
-            grid_internal.set_border_width(style.DEFAULT_PADDING)
-            grid_internal.set_size_request(
-                Gdk.Screen.width() - style.GRID_CELL_SIZE, -1)
-            self._grid_list.append(grid_internal)
-
-            row = 0
-
-            if status_message:
-                nick = None
-            elif me_message:
-                text = text[4:]
-
-            message = TextBox(self, nick_color, text_color, color_fill,
-                              highlight_fill, lang_rtl, nick, text)
-            self._message_list.append(message)
-            message.connect('open-on-journal', self.__open_on_journal)
+        if status_message:
+            nick = None
+        elif me_message:
+            text = text[4:]
+        return _Row(buddy, nick, text, bubble_style, tail, lang_rtl)
+
+    def _new_separator(self, timestamp):
+        return _Row(None, None, timestamp_to_elapsed_string(timestamp),
+                    self._separator_style, is_separator=True)
+
+    def load_history(self, history):
+        ''' Show the newest page of history, a chat.history.History,
+        in an empty conversation, and the older pages when the
+        conversation is scrolled up to them. '''
+        self.history = history
+        self._forget_older_match()
+        self.replay(history.read_page(_HISTORY_PAGE_SIZE))
+
+    def close(self):
+        ''' Close history and the spill file, when the conversation is
+        not shown any more '''
+        for source in (self.history, self._spill):
+            if source is not None:
+                source.close()
+        self.history = None
+        self._spill = None
+        self._forget_older_match()
+
+    def write_log(self, fileobj):
+        ''' Write the whole log, the records not in memory included, see
+        chat.log.ChatLog.write '''
+        older = [source for source in (self.history, self._spill)
+                 if source is not None]
+        self.log.write(fileobj, chain(*older))
+
+    def get_records(self):
+        ''' Every record, the ones not in memory included, oldest first,
+        as written by write_log '''
+        older = [source for source in (self.history, self._spill)
+                 if source is not None]
+        return chain(*(older + [self.log]))
+
+    def get_session_records(self):
+        ''' The records added or read since the conversation started,
+        oldest first, the spilled ones included '''
+        if self._spill is None:
+            return iter(self.log)
+        return chain(self._spill, self.log)
+
+    def show_timestamp(self, timestamp):
+        ''' Scroll to the first record at or after timestamp, loading
+        older records until it is in memory '''
+        while (not len(self.log) or self.log[0].timestamp > timestamp) and \
+                self._get_older() is not None:
+            self._prepend_page()
+        if not self._rows:
+            return
+        position = len(self.log) - 1
+        for i, record in enumerate(self.log):
+            if record.timestamp >= timestamp:
+                position = i
+                break
+        # The row of the record, see _Row.records
+        count = self._log_head
+        for index, row in enumerate(self._rows):
+            count += row.records
+            if count > position:
+                break
+        self._scroll_to_row(index)
+
+    def _get_older(self):
+        ''' The source of the records before the first row, None if
+        there are none '''
+        for source in (self._spill, self.history):
+            if source is not None and source.has_more():
+                return source
+        return None
 
-            self._last_msg_sender = buddy
-            self._last_msg = message
+    def _queue_history(self):
+        ''' Fetch an older page of history if the top of the viewport
+        is less than a page away from the top of the conversation '''
+        if self._history_id is not None or self._get_older() is None:
+            return
+        vadj = self.get_vadjustment()
+        if vadj.get_value() < vadj.get_page_size():
+            self._history_id = GLib.idle_add(self.__history_idle_cb)
 
-            grid_internal.attach(message, 0, row, 1, 1)
-            row += 1
+    def __history_idle_cb(self):
+        self._history_id = None
+        self._prepend_page()
+        return False
 
-            align = Gtk.Alignment.new(xalign=0.0, yalign=0.0, xscale=1.0,
-                                      yscale=1.0)
-            if rb.tail is None:
-                bottom_padding = style.zoom(7)
+    def _prepend_page(self):
+        source = self._get_older()
+        if source is not None:
+            self._prepend_records(source.read_page(_HISTORY_PAGE_SIZE))
+
+    def _prepend_records(self, records):
+        ''' Add older records of the saved log above the first row,
+        keeping the rows in the viewport in place '''
+        self._forget_older_match()
+        self.log.prepend(records)
+        rows = []
+        last_sender = None
+        for record in records:
+            if record.is_separator():
+                if rows and rows[-1].is_separator:
+                    rows[-1].records += 1
+                else:
+                    rows.append(self._new_separator(record.timestamp))
+                last_sender = None
+                continue
+            buddy = {'nick': record.nick, 'color': record.color}
+            if last_sender and buddy == last_sender and \
+                    not (record.status or _is_me_message(record.text)):
+                rows[-1].texts.append(record.text)
+                rows[-1].records += 1
+            else:
+                rows.append(self._new_row(buddy, record.nick, record.color,
+                                          record.text, record.status))
+                last_sender = buddy
+            if record.status:
+                last_sender = None
+        if rows and rows[-1].is_separator and self._rows and \
+                self._rows[0].is_separator:
+            self._log_head += rows.pop().records
+        if not rows:
+            return
+        # The records before the first row now follow the last new one
+        rows[-1].records += self._log_head
+        self._log_head = 0
+
+        count = len(rows)
+        if self._view is not None and self._rows:
+            # Keep the first row in place, see _scroll_changed_cb
+            self._anchor = (0, self.get_vadjustment().get_value() -
+                            self._get_row_y(0))
+        self._rows[0:0] = rows
+        self._shift_rows(count)
+        if self._pending is None and self.search_text != '':
+            matches = self._matches
+            self._matches = []
+            for i in range(count):
+                self._find_in_row(i)
+            found = len(self._matches)
+            self._matches.extend(matches)
+            if self._cursor is not None:
+                self._select(self._cursor + found)
+            elif self._matches:
+                self._select(0)
+            self.emit('search-updated')
+        if self._view is not None:
+            self._render_head(count)
+        self._queue_update()
+
+    def _render_head(self, count):
+        ''' Insert the count first rows at the start of the single
+        buffer '''
+        self._view.begin_prepend()
+        for index in range(count):
+            self._render_row(index)
+        length = self._view.end_prepend()
+        if len(self._rows) > count:
+            _buffer = self._view.get_buffer()
+            _buffer.move_mark(self._rows[count].mark,
+                              _buffer.get_iter_at_offset(length))
+
+    def _evict_rows(self):
+        ''' Move the oldest rows, past max_rows, to the spill file, a
+        page at a time.  This waits for the conversation to be scrolled
+        to the bottom, so that the viewport does not move. '''
+        if self._spill is None or not self._scroll_auto or \
+                len(self._rows) <= self._max_rows:
+            return
+        count = len(self._rows) - max(1, self._max_rows - _HISTORY_PAGE_SIZE)
+        # Only rows above the realized ones, and not the last one.  In
+        # single buffer mode, every row is realized and removed from
+        # the buffer.
+        if self._view is None:
+            count = min(count, self._first)
+        count = min(count, len(self._rows) - 1)
+        if count <= 0:
+            return
+        if self._view is not None:
+            self._view.remove_head(self._rows[count].mark)
+            _buffer = self._view.get_buffer()
+            for row in self._rows[:count]:
+                _buffer.delete_mark(row.mark)
+        records = self._log_head + sum(row.records
+                                       for row in self._rows[:count])
+        self._log_head = 0
+        self._spill.push(self.log.remove_oldest(records))
+        self._forget_older_match()
+        del self._rows[:count]
+        self._shift_rows(-count)
+        if self.search_text != '':
+            self.emit('search-updated')
+
+    def _shift_rows(self, delta):
+        ''' Renumber what refers to rows by index, delta rows having
+        been added above the first row, or -delta removed from the top
+        '''
+        if self._view is None:
+            self._first += delta
+            self._last += delta
+        else:
+            self._last = len(self._rows)
+        self._offsets_dirty = True
+        if self._anchor is not None:
+            index, offset = self._anchor
+            if index + delta >= 0:
+                self._anchor = (index + delta, offset)
             else:
-                bottom_padding = style.zoom(35)
-            align.set_padding(style.zoom(7), bottom_padding, style.zoom(30),
-                              style.zoom(30))
+                self._anchor = None
+
+        # The index is rebuilt, as it is only ever appended to
+        self._index = TextIndex()
+        self._indexed = 0
+        self._queue_indexing()
+        self._tagged = dict((i + delta, tagged)
+                            for i, tagged in self._tagged.items()
+                            if i + delta >= 0)
+        if self._pending is not None:
+            self.search_async(self.search_text)
+        elif self.search_text != '':
+            self._hits = dict((i + delta, starts)
+                              for i, starts in self._hits.items()
+                              if i + delta >= 0)
+            # Matches in removed rows are dropped
+            dropped = bisect.bisect_left(self._matches, (-delta, ))
+            self._matches = [(i + delta, start, end)
+                             for i, start, end in self._matches[dropped:]]
+            if self._cursor is not None:
+                cursor = self._cursor - dropped
+                if cursor >= 0:
+                    self._select(cursor)
+                else:
+                    self._select(0 if self._matches else None)
+                    self._highlight_row(self.highlight_text[2])
+
+    def _get_style(self, color):
+        ''' The _BubbleStyle of buddy color, None for status messages '''
+        bubble_style = self._styles.get(color)
+        if bubble_style is not None:
+            return bubble_style
+
+        if color is None:
+            bubble_style = _BubbleStyle(
+                style.COLOR_WHITE, style.COLOR_WHITE, style.Color('#808080'),
+                style.COLOR_WHITE)
+            self._styles[color] = bubble_style
+            return bubble_style
+
+        colors = color.split(',')
+        try:
+            color_stroke_html, color_fill_html = colors
+        except ValueError:
+            color_stroke_html, color_fill_html = ('#000000', '#888888')
 
-            align.add(grid_internal)
-            grid_internal.show()
+        lighter = lighter_color(colors)
+        darker = 1 - lighter
 
-            rb.pack_start(align, True, True, 0)
-            align.show()
+        if is_dark_too_light(colors[darker]):
+            text_color = style.COLOR_BLACK
+            darker = lighter  # use black on lighter of the two colors
+        else:
+            text_color = style.COLOR_WHITE
+        if darker == 0:
+            color_fill = style.Color(color_stroke_html)
+            if is_low_contrast(colors):
+                nick_color = text_color
+            else:
+                nick_color = style.Color(color_fill_html)
+        else:
+            color_fill = style.Color(color_fill_html)
+            if is_low_contrast(colors):
+                nick_color = text_color
+            else:
+                nick_color = style.Color(color_stroke_html)
 
-            self._conversation.attach(rb, 0, self._row_counter, 1, 1)
-            rb.show()
-            self._row_counter += 1
-            message.show()
+        bubble_style = _BubbleStyle(nick_color, text_color, color_fill,
+                                    style.COLOR_BUTTON_GREY)
+        self._styles[color] = bubble_style
+        return bubble_style
 
-        if status_message:
-            self._last_msg_sender = None
+    def add_separator(self, timestamp):
+        '''Add whitespace and timestamp between chat sessions.
+        timestamp -- seconds since the epoch'''
+        self._append_row(self._new_separator(timestamp))
+        self.log.append_separator(timestamp)
+        self._last_msg_sender = None
 
-        self.emit("new-message")
+    def _update_row(self, index, length=0):
+        ''' Index the text of the row at index past length, its previous
+        length, and find and tag the matches there.  The selected match
+        is kept. '''
+        if self._replaying:
+            # See replay
+            return
+        if self._indexed >= index:
+            self._index.update(index, self._get_row_text(self._rows[index]))
+            self._indexed = index + 1
+        else:
+            self._queue_indexing()
+        if self._pending is not None:
+            self._search_end = min(self._search_end, index)
+        elif self.search_text != '':
+            count = len(self._matches)
+            # Matches overlapping the old end of the row are new too
+            start = max(0, length - len(self.search_text) + 1)
+            if index in self._hits:
+                start = max(start,
+                            self._hits[index][-1] + len(self.search_text))
+            self._find_in_row(index, start)
+            if len(self._matches) != count:
+                if self._cursor is None:
+                    self._select(0)
+                self._highlight_row(index)
+                self.emit('search-updated')
+
+    def _queue_indexing(self):
+        if self._index_id is None and self._indexed < len(self._rows):
+            self._index_id = GLib.idle_add(self.__index_idle_cb)
+
+    def __index_idle_cb(self):
+        ''' Index rows for _SEARCH_BUDGET seconds '''
+        deadline = time.time() + _SEARCH_BUDGET
+        while self._indexed < len(self._rows):
+            self._index.update(self._indexed,
+                               self._get_row_text(self._rows[self._indexed]))
+            self._indexed += 1
+            if time.time() > deadline:
+                return True
+        self._index_id = None
+        return False
 
-    def add_separator(self, timestamp):
-        '''Add whitespace and timestamp between chat sessions.'''
-        time_with_current_year = \
-            (time.localtime(time.time())[0], ) + \
-            time.strptime(timestamp, '%b %d %H:%M:%S')[1:]
-
-        timestamp_seconds = time.mktime(time_with_current_year)
-        if timestamp_seconds > time.time():
-            time_with_previous_year = \
-                (time.localtime(time.time())[0] - 1, ) + \
-                time.strptime(timestamp, '%b %d %H:%M:%S')[1:]
-            timestamp_seconds = time.mktime(time_with_previous_year)
-
-        message = TextBox(self,
-                          style.COLOR_BUTTON_GREY, style.COLOR_BUTTON_GREY,
-                          style.COLOR_WHITE, style.COLOR_BUTTON_GREY, False,
-                          None, timestamp_to_elapsed_string(timestamp_seconds))
+    def _append_row(self, row):
+        self._rows.append(row)
+        self._update_row(len(self._rows) - 1)
+        if self._view is not None:
+            self._render_row(len(self._rows) - 1)
+        elif not self._offsets_dirty:
+            self._offsets.append(self._offsets[-1] + self._row_height(row))
+        self._queue_update()
+
+    def _row_height(self, row):
+        ''' Allocated height of the row, or a guess if it was never
+        realized. '''
+        if row.height is not None:
+            return row.height
+
+        chars_per_line = max(
+            1, int(self.geometry.bubble_width / _CHAR_WIDTH))
+        lines = 0
+        for text in row.texts:
+            lines += 1 + len(text) // chars_per_line
+        height = lines * _LINE_HEIGHT + style.DEFAULT_PADDING
+        if not row.is_separator:
+            # Borders and paddings of the bubble, see _get_shell
+            height += 2 * style.DEFAULT_PADDING + style.zoom(7) + \
+                2 * style.zoom(5)
+            if row.tail is None:
+                height += style.zoom(7)
+            else:
+                height += style.zoom(35)
+        return height
+
+    def _get_offsets(self):
+        if self._offsets_dirty:
+            self._offsets = [0]
+            self._offsets.extend(
+                accumulate(self._row_height(row) for row in self._rows))
+            self._offsets_dirty = False
+        return self._offsets
+
+    def _render_row(self, index):
+        ''' Append the row at index to the single buffer '''
+        row = self._rows[index]
+        name_tag, tags = self._get_row_tags(row)
+        row.mark = self._view.add_row(row.nick, row.texts[0], name_tag, tags)
+        for text in row.texts[1:]:
+            self._view.add_text(text)
+        row.textbox = self._view
+        self._last = len(self._rows)
+
+        if self.search_text != '':
+            self._highlight_row(index)
+
+    def _get_row_tags(self, row):
+        ''' Tags drawing the bubble of row in the single buffer, created
+        once for each color scheme '''
+        bubble_style = row.style
+        key = (bubble_style, row.tail)
+        if key not in self._row_tags:
+            _buffer = self._view.get_buffer()
+            if row.is_separator:
+                bubble = _buffer.create_tag(
+                    None, foreground=bubble_style.text_color.get_html(),
+                    justification=Gtk.Justification.CENTER,
+                    pixels_above_lines=style.DEFAULT_PADDING)
+            else:
+                # The tail side of the bubble is a wider margin
+                if row.tail == 'right':
+                    left_margin = style.zoom(30)
+                    right_margin = style.GRID_CELL_SIZE
+                elif row.tail == 'left':
+                    left_margin = style.GRID_CELL_SIZE
+                    right_margin = style.zoom(30)
+                else:
+                    left_margin = right_margin = style.zoom(30)
+                bubble = _buffer.create_tag(
+                    None, foreground=bubble_style.text_color.get_html(),
+                    paragraph_background=bubble_style.color_fill.get_html(),
+                    left_margin=left_margin, right_margin=right_margin,
+                    pixels_above_lines=style.DEFAULT_PADDING,
+                    pixels_below_lines=style.DEFAULT_PADDING)
+            name_tag = _buffer.create_tag(
+                None, foreground=bubble_style.nick_color.get_html(),
+                weight=Pango.Weight.BOLD)
+            self._row_tags[key] = (name_tag, (bubble,))
+        return self._row_tags[key]
+
+    def _queue_update(self):
+        if self._update_id is None:
+            self._update_id = GLib.idle_add(self._update_window)
+
+    def _update_window(self):
+        ''' Realize the rows in and around the viewport, and unrealize
+        the others. '''
+        self._update_id = None
+        self._evict_rows()
+        if self._view is not None:
+            # Every row is realized
+            return False
+        offsets = self._get_offsets()
+        vadj = self.get_vadjustment()
+        page = vadj.get_page_size() or self.geometry.screen_height
+        if self._scroll_auto:
+            bottom = offsets[-1]
+            top = bottom - 2 * page
+        else:
+            value = vadj.get_value()
+            if self._anchor is not None:
+                # Ahead of _scroll_changed_cb when rows were added above
+                index, delta = self._anchor
+                value = offsets[index] + delta
+            top = value - page
+            bottom = value + 2 * page
+
+        first = max(0, bisect.bisect_right(offsets, top) - 1)
+        last = max(first, min(len(self._rows),
+                              bisect.bisect_left(offsets, bottom)))
+
+        for index in range(self._first, self._last):
+            if index < first or index >= last:
+                self._unrealize_row(index)
+        for index in range(first, last):
+            row = self._rows[index]
+            if row.widget is None:
+                self._realize_row(index)
+            self._conversation.reorder_child(row.widget, 1 + index - first)
+        self._first = first
+        self._last = last
+
+        self._top_spacer.set_size_request(-1, offsets[first])
+        self._bottom_spacer.set_size_request(-1, offsets[-1] - offsets[last])
+        return False
+
+    def _realize_row(self, index):
+        row = self._rows[index]
+        bubble_style = row.style
+        if row.is_separator:
+            message = TextBox(self, bubble_style.nick_color,
+                              bubble_style.text_color,
+                              bubble_style.color_fill,
+                              bubble_style.highlight_fill, False, None,
+                              row.texts[0], bubble_style.get_tag_table())
+            widget = Gtk.HBox()
+            align = Gtk.Alignment.new(
+                xalign=0.5, yalign=0.0, xscale=0.0, yscale=0.0)
+            widget.pack_start(align, True, True, 0)
+            align.show()
+            align.add(message)
+            widget.connect('size-allocate', self.__row_size_allocate_cb)
+        else:
+            message = TextBox(self, bubble_style.nick_color,
+                              bubble_style.text_color,
+                              bubble_style.color_fill,
+                              bubble_style.highlight_fill, row.lang_rtl,
+                              row.nick, row.texts[0],
+                              bubble_style.get_tag_table())
+            for text in row.texts[1:]:
+                message.add_text(text)
+            widget, grid = self._get_shell(bubble_style.color_fill, row.tail)
+            grid.attach(message, 0, 0, 1, 1)
+        message.connect('open-on-journal', self.__open_on_journal)
         self._message_list.append(message)
-        box = Gtk.HBox()
-        align = Gtk.Alignment.new(
-            xalign=0.5, yalign=0.0, xscale=0.0, yscale=0.0)
-        box.pack_start(align, True, True, 0)
-        align.show()
-        align.add(message)
         message.show()
-        self._conversation.attach(box, 0, self._row_counter, 1, 1)
-        box.show()
-        self._row_counter += 1
-        self.add_log_timestamp(timestamp)
-        self._last_msg_sender = None
+
+        widget.row = row
+        row.widget = widget
+        row.textbox = message
+        self._conversation.pack_start(widget, False, False, 0)
+        widget.show()
+
+        if self.search_text != '':
+            self._highlight_row(index)
+
+    def _unrealize_row(self, index):
+        row = self._rows[index]
+        self._tagged.pop(index, None)
+        widget = row.widget
+        message = row.textbox
+        widget.row = None
+        row.widget = None
+        row.textbox = None
+
+        self._conversation.remove(widget)
+        self._message_list.remove(message)
+        if row.is_separator:
+            widget.destroy()
+        else:
+            grid = message.get_parent()
+            grid.remove(message)
+            self._rb_list.remove(widget)
+            self._grid_list.remove(grid)
+            if len(self._shells) < _SHELL_POOL_SIZE:
+                self._shells.append((widget, grid.get_parent(), grid))
+            else:
+                widget.destroy()
+        message.destroy()
+
+    def _get_shell(self, color_fill, tail):
+        ''' Return a bubble, recycled if possible, ready for a TextBox '''
+        if self._shells:
+            rb, align, grid = self._shells.pop()
+        else:
+            rb = RoundBox()
+            rb.border_color = None
+            rb.connect('size-allocate', self.__row_size_allocate_cb)
+
+            grid = Gtk.Grid()
+            grid.set_row_spacing(0)
+            grid.set_border_width(style.DEFAULT_PADDING)
+
+            align = Gtk.Alignment.new(xalign=0.0, yalign=0.0, xscale=1.0,
+                                      yscale=1.0)
+            align.add(grid)
+            grid.show()
+
+            rb.pack_start(align, True, True, 0)
+            align.show()
+
+        # Pooled shells may predate a resize
+        width = self.geometry.bubble_width
+        grid.set_size_request(width, -1)
+        rb.set_size_request(width, -1)
+        rb.background_color = color_fill
+        rb.tail = tail
+        if rb.tail is None:
+            bottom_padding = style.zoom(7)
+        else:
+            bottom_padding = style.zoom(35)
+        align.set_padding(style.zoom(7), bottom_padding, style.zoom(30),
+                          style.zoom(30))
+
+        self._rb_list.append(rb)
+        self._grid_list.append(grid)
+        return rb, grid
+
+    def __row_size_allocate_cb(self, widget, allocation):
+        row = getattr(widget, 'row', None)
+        if row is None:
+            return
+        height = allocation.height + style.DEFAULT_PADDING
+        if row.height != height:
+            row.height = height
+            self._offsets_dirty = True
+            self._queue_update()
 
     def add_log_timestamp(self, existing_timestamp=None):
         '''Add a timestamp entry to the chat log.'''
         if existing_timestamp is not None:
-            self._chat_log += '%s\t\t\n' % existing_timestamp
+            self.log.append_separator(
+                parse_legacy_timestamp(existing_timestamp))
         else:
-            self._chat_log += '%s\t\t\n' % (
-                datetime.strftime(datetime.now(), '%b %d %H:%M:%S'))
-
-    def _add_log(self, nick, color, text, status_message):
-        '''Add the text to the chat log.
-        nick -- string, buddy nickname
-        color -- string, buddy.props.color
-        text -- string, body of message
-        status_message -- boolean
-        '''
-        if not nick:
-            nick = '???'
-        if not color:
-            color = '#000000,#FFFFFF'
-        if not text:
-            text = '-'
-        if not status_message:
-            status_message = False
-        self._chat_log += '%s\t%s\t%s\t%d\t%s\n' % (
-            datetime.strftime(datetime.now(), '%b %d %H:%M:%S'),
-            nick, color, status_message, text)
+            self.log.append_separator()
+        if self._rows:
+            self._rows[-1].records += 1
+        else:
+            self._log_head += 1
 
     def _scroll_value_changed_cb(self, adj, scroll=None):
         '''Turn auto scrolling on or off.
@@ -795,24 +1749,82 @@ class ChatBox(Gtk.ScrolledWindow):
         elif adj.get_value() == adj.get_upper() - adj.get_page_size():
             self._scroll_auto = True
 
+        if self._view is not None:
+            # The row kept in place since older rows were added above,
+            # see _prepend_records
+            if self._anchor is not None:
+                index = self._anchor[0]
+                self._anchor = (index,
+                                adj.get_value() - self._get_row_y(index))
+        else:
+            # Remember which row is at the top of the viewport
+            offsets = self._get_offsets()
+            index = bisect.bisect_right(offsets, adj.get_value()) - 1
+            if 0 <= index < len(self._rows):
+                self._anchor = (index, adj.get_value() - offsets[index])
+        self._queue_update()
+        self._queue_history()
+
     def _scroll_changed_cb(self, adj, scroll=None):
-        '''Scroll the chat window to the bottom'''
+        '''Scroll the chat window to the bottom, or keep the row at the
+        top of the viewport in place while rows above it are realized.
+        '''
         if self._scroll_auto:
-            adj.set_value(adj.get_upper() - adj.get_page_size())
+            # Set first, as the value goes down when rows are evicted
+            self._scroll_value = adj.get_upper() - adj.get_page_size()
+            adj.set_value(self._scroll_value)
             self._scroll_value = adj.get_value()
+        elif self._anchor is not None:
+            index, delta = self._anchor
+            value = self._get_row_y(index) + delta
+            if value != adj.get_value():
+                adj.set_value(value)
+        self._queue_update()
+        self._queue_history()
+
+    def _get_row_y(self, index):
+        ''' The y position of the row at index in the conversation '''
+        if self._view is None:
+            return self._get_offsets()[index]
+        _buffer = self._view.get_buffer()
+        return self._view.get_iter_location(
+            _buffer.get_iter_at_mark(self._rows[index].mark)).y
+
+    def __geometry_changed_cb(self, geometry):
+        self.resize_all()
 
     def resize_all(self):
         for message in self._message_list:
             message.resize_box()
+        # Guessed heights depend on the width
+        for row in self._rows:
+            if row.textbox is None:
+                row.height = None
+        self._offsets_dirty = True
+        self._queue_update()
         self.resize_rb()
 
+    def queue_resize_rb(self):
+        ''' Call resize_rb once the current layout pass is done, however
+        many TextBoxes ask for it meanwhile '''
+        if self._resize_id is None:
+            self._resize_id = GLib.idle_add(self.__resize_idle_cb)
+
+    def __resize_idle_cb(self):
+        self._resize_id = None
+        self.resize_rb()
+        return False
+
     def resize_rb(self):
-        for grid in self._grid_list:
-            grid.set_size_request(
-                Gdk.Screen.width() - style.GRID_CELL_SIZE, -1)
-        for rb in self._rb_list:
-            rb.set_size_request(
-                Gdk.Screen.width() - style.GRID_CELL_SIZE, -1)
+        # New bubbles get the current width, see _get_shell, so there
+        # is nothing to do unless the width changed
+        width = self.geometry.bubble_width
+        if width != self._rb_width:
+            self._rb_width = width
+            for grid in self._grid_list:
+                grid.set_size_request(width, -1)
+            for rb in self._rb_list:
+                rb.set_size_request(width, -1)
         self.resize_conversation()
 
     def resize_conversation(self, dy=None):
@@ -822,9 +1834,13 @@ class ChatBox(Gtk.ScrolledWindow):
         else:
             self._dy = dy
 
-        self._conversation.set_size_request(
-            Gdk.Screen.width() - style.GRID_CELL_SIZE,
-            Gdk.Screen.height() - 2 * style.GRID_CELL_SIZE - dy)
+        if self._conversation is None:
+            return
+        size = (self.geometry.bubble_width,
+                self.geometry.conversation_height - dy)
+        if size != self._conversation_size:
+            self._conversation_size = size
+            self._conversation.set_size_request(*size)
 
 
 class ContentInvoker(Invoker):
@@ -0,0 +1,52 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gi.repository import GObject
+from gi.repository import Gdk
+
+from sugar3.graphics import style
+
+
+class Geometry(GObject.GObject):
+    '''Sizes of the chat derived from the screen size.  The screen is
+    only queried by update, which the activity calls when the screen
+    is resized; changed is emitted if the sizes changed.
+    '''
+
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.screen_width = None
+        self.screen_height = None
+        self.update()
+
+    def update(self):
+        width = Gdk.Screen.width()
+        height = Gdk.Screen.height()
+        if (width, height) == (self.screen_width, self.screen_height):
+            return
+        self.screen_width = width
+        self.screen_height = height
+        # Width of the conversation and of its bubbles
+        self.bubble_width = width - style.GRID_CELL_SIZE
+        # Width of the text in a bubble
+        self.text_width = self.bubble_width - 2 * style.DEFAULT_SPACING
+        # Height of the conversation, without the OSK
+        self.conversation_height = height - 2 * style.GRID_CELL_SIZE
+        self.emit('changed')
@@ -0,0 +1,96 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' The records of a journal file not loaded yet, read a page at a time
+from the newest '''
+
+import os
+from itertools import islice
+
+from chat import log
+from chat.reader import ReverseReader
+
+
+class History(object):
+    ''' The records of the journal file at path, read by read_page
+    from the newest.  Nothing but the offset of the oldest record read
+    is kept in memory. '''
+
+    def __init__(self, path):
+        self._reader = ReverseReader(path)
+
+    def has_more(self):
+        return self._reader.position > self._reader.start
+
+    def __iter__(self):
+        ''' The records not read yet, oldest first, for saving them '''
+        return self._reader.get_unread()
+
+    def read_page(self, count=None):
+        ''' The count newest records not read yet, or all of them if
+        count is None, oldest first '''
+        records = list(islice(self._reader, count))
+        records.reverse()
+        return records
+
+    def find(self, text, match):
+        ''' Yield the offset of the newest record not read yet holding
+        text, for which match is true, after None for every record
+        skipped, see ReverseReader.find '''
+        return self._reader.find(text, match)
+
+    def read_to(self, offset):
+        ''' The records not read yet, from the newest to the one at
+        offset, see find, oldest first '''
+        records = []
+        for record in self._reader:
+            records.append(record)
+            if self._reader.position <= offset:
+                break
+        records.reverse()
+        return records
+
+    def close(self):
+        self._reader.close()
+
+
+class Spill(History):
+    ''' Records removed from the conversation to bound its memory, in
+    a journal file at path.  They are pushed oldest first, and read
+    back by read_page from the newest.  The file is removed on close.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'w') as f:
+            f.write(log.HEADER)
+        History.__init__(self, path)
+
+    def push(self, records):
+        ''' Add records newer than the others '''
+        # The records read back are overwritten
+        position = self._reader.position
+        self._reader.close()
+        with open(self._path, 'r+b') as f:
+            f.seek(position)
+            f.truncate()
+            for record in records:
+                f.write(record.to_line().encode('ascii'))
+        self._reader = ReverseReader(self._path)
+
+    def close(self):
+        History.close(self)
+        os.unlink(self._path)
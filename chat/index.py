@@ -0,0 +1,75 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' Trigram index of the rows of a conversation, for the search '''
+
+from bisect import bisect_left
+
+# Length of the indexed substrings
+_N = 3
+
+
+def _contains(rows, index):
+    i = bisect_left(rows, index)
+    return i < len(rows) and rows[i] == index
+
+
+class TextIndex(object):
+    ''' Maps each substring of length 3 of the rows texts to the sorted
+    list of the rows holding it.  Rows are numbered in order, and only
+    the last one can grow, at its end, so that updates are appends. '''
+
+    def __init__(self):
+        self._postings = {}
+        # Indexed length of each row
+        self._lengths = []
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def update(self, index, text):
+        ''' Index text, the whole text of the row at index.  The row is
+        either a new one or the last one, text having grown at its end.
+        '''
+        if index == len(self._lengths):
+            self._lengths.append(0)
+        postings = self._postings
+        # Substrings across the old end of the row are new too
+        for i in range(max(0, self._lengths[index] - _N + 1),
+                       len(text) - _N + 1):
+            gram = text[i:i + _N]
+            rows = postings.get(gram)
+            if rows is None:
+                postings[gram] = [index]
+            elif rows[-1] != index:
+                rows.append(index)
+        self._lengths[index] = len(text)
+
+    def candidates(self, query):
+        ''' Sorted indexes of the rows that may contain query, or None if
+        query is too short to be looked up. '''
+        if len(query) < _N:
+            return None
+        lists = []
+        for gram in set(query[i:i + _N] for i in range(len(query) - _N + 1)):
+            rows = self._postings.get(gram)
+            if rows is None:
+                return []
+            lists.append(rows)
+        lists.sort(key=len)
+        others = lists[1:]
+        return [index for index in lists[0]
+                if all(_contains(rows, index) for rows in others)]
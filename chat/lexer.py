@@ -0,0 +1,118 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import re
+from collections import OrderedDict
+
+from gi.repository import GdkPixbuf
+
+from chat import smilies
+from chat import urls
+
+RUN_TEXT = 0
+RUN_URL = 1
+RUN_SMILEY = 2
+
+_SPACES = re.compile(r'(\s+)')
+
+
+def _tokenize(word):
+    ''' Split a word into (kind, value) runs '''
+    if urls.is_url(word):
+        return ((RUN_URL, word),)
+    tokens = []
+    for i in smilies.parse(word):
+        if isinstance(i, GdkPixbuf.Pixbuf):
+            tokens.append((RUN_SMILEY, i))
+        elif i:
+            tokens.append((RUN_TEXT, i))
+    return tuple(tokens)
+
+
+def get_text(runs):
+    ''' Return the text of runs, with U+FFFC standing for each smiley
+    like in a Gtk.TextBuffer. '''
+    return ''.join('\ufffc' if kind == RUN_SMILEY else value
+                   for kind, value in runs)
+
+
+class Lexer(object):
+    '''Turn messages into runs of plain text, links and smilies.
+
+    Whitespace is kept as it was typed and merged, with the plain text
+    around it, into a single RUN_TEXT run, so that a message is
+    inserted with one call per run.
+
+    Words are tokenized through a bounded LRU shared by every message
+    of a ChatBox, since the same words, smilies and links keep coming
+    back.
+    '''
+
+    def __init__(self, size=1024):
+        self._size = size
+        self._tokens = OrderedDict()
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def lex(self, text):
+        '''Return the list of (kind, value) runs of text.
+        value is a string, except for RUN_SMILEY where it is a pixbuf.
+        '''
+        runs = []
+        plain = []
+        for index, word in enumerate(_SPACES.split(text)):
+            if index % 2:
+                # Whitespace
+                plain.append(word)
+                continue
+            if not word:
+                continue
+            for kind, value in self.get_tokens(word):
+                if kind == RUN_TEXT:
+                    plain.append(value)
+                    continue
+                if plain:
+                    runs.append((RUN_TEXT, ''.join(plain)))
+                    plain = []
+                runs.append((kind, value))
+        if plain:
+            runs.append((RUN_TEXT, ''.join(plain)))
+        return runs
+
+    def get_tokens(self, word):
+        ''' Return the runs of a word without whitespace '''
+        smilies.init()
+        if self._generation != smilies.get_generation():
+            # Cached smiley pixbufs belong to the previous theme
+            self.clear()
+            self._generation = smilies.get_generation()
+
+        try:
+            tokens = self._tokens[word]
+        except KeyError:
+            self.misses += 1
+            tokens = _tokenize(word)
+            if len(self._tokens) >= self._size:
+                self._tokens.popitem(last=False)
+            self._tokens[word] = tokens
+        else:
+            self.hits += 1
+            self._tokens.move_to_end(word)
+        return tokens
+
+    def clear(self):
+        self._tokens.clear()
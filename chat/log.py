@@ -0,0 +1,185 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''The chat log saved to the journal.
+
+The journal file is JSON Lines, a header and a line per record:
+
+    {"chat-log": 2}
+    {"t":1400000000.0}
+    {"t":1400000005.5,"n":"nick","c":"#000000,#FFFFFF","s":0,"m":"text"}
+
+Separators have no "m".  Lines are ASCII, see chat.reader for reading
+them from the newest.  Version 1 files, from older versions of Chat, are
+tab-separated lines with timestamps lacking the year:
+
+    Jan 01 10:00:00\t\t
+    Jan 01 10:00:05\tnick\t#000000,#FFFFFF\t0\ttext
+'''
+
+import json
+import time
+import logging
+from itertools import chain
+
+VERSION = 2
+# First line of the journal files written
+HEADER = json.dumps({'chat-log': VERSION}) + '\n'
+
+# Timestamps of version 1 files, which have no year
+_LEGACY_FORMAT = '%b %d %H:%M:%S'
+
+
+def parse_legacy_timestamp(timestamp):
+    '''Seconds since the epoch of a journal timestamp, taken to be in
+    the last twelve months.'''
+    now = time.time()
+    fields = time.strptime(timestamp, _LEGACY_FORMAT)[1:]
+    seconds = time.mktime((time.localtime(now)[0], ) + fields)
+    if seconds > now:
+        seconds = time.mktime((time.localtime(now)[0] - 1, ) + fields)
+    return seconds
+
+
+class Record(object):
+    '''A message of the log, or a separator between sessions if text
+    is None.'''
+
+    __slots__ = ('timestamp', 'nick', 'color', 'status', 'text')
+
+    def __init__(self, timestamp, nick=None, color=None, status=False,
+                 text=None):
+        self.timestamp = timestamp
+        self.nick = nick
+        self.color = color
+        self.status = status
+        self.text = text
+
+    def is_separator(self):
+        return self.text is None
+
+    def to_line(self):
+        '''The line of the journal file for the record.'''
+        if self.text is None:
+            data = {'t': self.timestamp}
+        else:
+            data = {'t': self.timestamp, 'n': self.nick, 'c': self.color,
+                    's': int(self.status), 'm': self.text}
+        return json.dumps(data, separators=(',', ':')) + '\n'
+
+    @staticmethod
+    def from_line(line):
+        data = json.loads(line)
+        if 'm' not in data:
+            return Record(data['t'])
+        return Record(data['t'], data['n'], data['c'], bool(data['s']),
+                      data['m'])
+
+
+class ChatLog(object):
+    '''Records of a chat session, in order.'''
+
+    def __init__(self):
+        self._records = []
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __getitem__(self, index):
+        return self._records[index]
+
+    def append(self, nick, color, text, status_message, timestamp=None):
+        '''Add a message.
+        nick -- string, buddy nickname
+        color -- string, buddy.props.color
+        text -- string, body of message
+        status_message -- boolean
+        timestamp -- seconds since the epoch, now if None
+        '''
+        if not nick:
+            nick = '???'
+        if not color:
+            color = '#000000,#FFFFFF'
+        if not text:
+            text = '-'
+        if timestamp is None:
+            timestamp = time.time()
+        record = Record(timestamp, nick, color, bool(status_message), text)
+        self._records.append(record)
+        return record
+
+    def append_separator(self, timestamp=None):
+        '''Add a separator between sessions.'''
+        if timestamp is None:
+            timestamp = time.time()
+        record = Record(timestamp)
+        self._records.append(record)
+        return record
+
+    def prepend(self, records):
+        '''Add older records, see chat.history.History.'''
+        self._records[0:0] = records
+
+    def remove_oldest(self, count):
+        '''Remove the count oldest records, and return them.'''
+        records = self._records[:count]
+        del self._records[:count]
+        return records
+
+    def write(self, fileobj, older=()):
+        '''Write the older records, then the log, to fileobj, a line at
+        a time.'''
+        write_records(fileobj, chain(older, self._records))
+
+
+def write_records(fileobj, records):
+    '''Write a journal file of records to fileobj.'''
+    fileobj.write(HEADER)
+    for record in records:
+        fileobj.write(record.to_line())
+
+
+def get_version(first):
+    '''The version of a journal file starting with line first.'''
+    if first.startswith('{'):
+        header = json.loads(first)
+        if header.get('chat-log', 0) > VERSION:
+            logging.warning('Chat log version %s is newer than %s',
+                            header.get('chat-log'), VERSION)
+        return VERSION
+    return 1
+
+
+def parse_record(line, version):
+    '''The record of a line of a journal file, None if it is bad.'''
+    try:
+        if version == 1:
+            return _parse_legacy(line)
+        return Record.from_line(line)
+    except (ValueError, KeyError):
+        logging.warning('Skipping bad chat log line %r', line)
+        return None
+
+
+def _parse_legacy(line):
+    if line.endswith('\t\t\n'):
+        return Record(parse_legacy_timestamp(line.split('\t', 1)[0]))
+    timestamp, nick, color, status, text = line.rstrip('\n').split('\t', 4)
+    return Record(parse_legacy_timestamp(timestamp), nick, color,
+                  bool(int(status)), text)
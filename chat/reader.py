@@ -0,0 +1,196 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' Reading a journal file backward, see chat.log for its format '''
+
+import os
+import json
+import mmap
+
+from chat import log
+
+
+class ReverseReader(object):
+    ''' Iterates over the records of a journal file from the newest to
+    the oldest.  The file is mapped rather than read: lines are found
+    in the mapping and only the lines of the records returned are
+    copied and decoded. '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty files cannot be mapped
+                self._map = b''
+        self._view = memoryview(self._map)
+        size = len(self._map)
+
+        header_end = self._map.find(b'\n') + 1 or size
+        self.version = log.get_version(
+            str(self._view[:header_end], 'utf-8'))
+        if self.version == 1:
+            self.start = 0
+        else:
+            self.start = header_end
+        # Records from start to position have not been returned yet
+        self.position = size
+
+    def close(self):
+        self._view.release()
+        if self._map:
+            self._map.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.position > self.start:
+            end = self.position
+            self.position = self._line_start(end)
+            record = self._parse(self.position, end)
+            if record is not None:
+                return record
+        raise StopIteration
+
+    def get_unread(self):
+        ''' Yield the records not returned yet, oldest first '''
+        begin = self.start
+        while begin < self.position:
+            end = self._map.find(b'\n', begin, self.position) + 1
+            if not end:
+                end = self.position
+            record = self._parse(begin, end)
+            if record is not None:
+                yield record
+            begin = end
+
+    def find(self, text, match):
+        ''' Yield the offset of the newest line not returned yet holding
+        text in its nick or message, the record of which match is true
+        for, after None for every line skipped on the way, so that the
+        search can be spread over several main loop iterations.  Only
+        the lines holding text in their nick or message are decoded. '''
+        if self.version == 1:
+            needle = text.encode('utf-8')
+        else:
+            # Escaped as in the lines, see chat.log.Record.to_line
+            needle = json.dumps(text)[1:-1].encode('ascii')
+        end = self.position
+        while True:
+            found = self._map.rfind(needle, self.start, end)
+            if found < 0:
+                return
+            begin = self._line_start(found + 1)
+            line_end = self._map.find(b'\n', found, self.position) + 1 or \
+                self.position
+            # This is the last match in the line, maybe in a timestamp,
+            # a color or a key: decode only if the nick or the message
+            # hold one too
+            stop = found + len(needle)
+            if any(self._map.find(needle, start, min(stop, field_end)) >= 0
+                   for start, field_end in self._get_fields(begin, line_end)):
+                record = self._parse(begin, line_end)
+                if record is not None and match(record):
+                    yield begin
+                    return
+            end = begin
+            yield None
+
+    def _get_fields(self, begin, end):
+        ''' The spans of the nick and of the message in the line from
+        begin to end, none for separators '''
+        if self.version == 1:
+            # timestamp, nick, color, status and text, tab separated
+            tabs = [begin - 1]
+            for i in range(4):
+                tab = self._map.find(b'\t', tabs[-1] + 1, end)
+                if tab < 0:
+                    return ()
+                tabs.append(tab)
+            return ((tabs[1] + 1, tabs[2]), (tabs[4] + 1, end))
+        # The strings have their quotes escaped, so the keys are found
+        # from the start of the line, see chat.log.Record.to_line
+        nick = self._map.find(b',"n":"', begin, end)
+        text = self._map.find(b',"m":"', begin, end)
+        if nick < 0 or text < 0:
+            return ()
+        color = self._map.find(b'","c":"', nick, end)
+        text_end = self._map.rfind(b'"', text, end)
+        return ((nick + 6, color), (text + 6, text_end))
+
+    def _line_start(self, end):
+        ''' Offset of the line ending at end '''
+        return max(self.start,
+                   self._map.rfind(b'\n', self.start, max(0, end - 1)) + 1)
+
+    def _parse(self, begin, end):
+        return log.parse_record(str(self._view[begin:end], 'utf-8'),
+                                self.version)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import random
+    import tempfile
+    from itertools import islice
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rng = random.Random(0)
+    words = ['hello', 'world', 'sugar', 'chat', 'http://sugarlabs.org',
+             ':-)', 'lorem', 'ipsum', 'dolor', 'amet']
+    chat_log = log.ChatLog()
+    written = 0
+    while written < size * 1024 * 1024:
+        if len(chat_log) % 1000 == 0:
+            record = chat_log.append_separator()
+        else:
+            record = chat_log.append(
+                rng.choice(['ana', 'bob', 'eve']), '#FF0000,#00FF00',
+                ' '.join(rng.choice(words) for i in range(10)), False)
+        written += len(record.to_line())
+    fd, path = tempfile.mkstemp(suffix='.chat')
+    with os.fdopen(fd, 'w') as f:
+        chat_log.write(f)
+    del chat_log
+    print('%d MB, %d bytes' % (size, os.path.getsize(path)))
+
+    def readlines(count):
+        with open(path) as f:
+            lines = f.readlines()
+        version = log.get_version(lines[0])
+        lines = lines[1:]
+        return [log.parse_record(line, version)
+                for line in lines[::-1][:count]]
+
+    def reverse(count):
+        reader = ReverseReader(path)
+        records = list(islice(reader, count))
+        reader.close()
+        return records
+
+    try:
+        for count in (200, 10000, None):
+            timings = []
+            for read in (readlines, reverse):
+                start = time.time()
+                records = read(count)
+                timings.append(time.time() - start)
+            print('%s newest records: readlines %.3fs, reverse %.3fs' % (
+                len(records), timings[0], timings[1]))
+    finally:
+        os.unlink(path)
@@ -0,0 +1,95 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gi.repository import GObject
+from gi.repository import Gtk
+from gi.repository import Gdk
+
+from chat import smilies
+
+
+class SmileyTable(Gtk.DrawingArea):
+    '''Grid of every smiley in the theme, drawn from a single atlas
+    pixbuf (see smilies.get_atlas) instead of one widget per smiley.
+    '''
+
+    __gsignals__ = {
+        'smiley-activated': (GObject.SignalFlags.RUN_FIRST, None, ([str])),
+    }
+
+    def __init__(self, pixel_size, spacing):
+        Gtk.DrawingArea.__init__(self)
+        self._pixel_size = int(pixel_size)
+        self._spacing = int(spacing)
+        self._columns = 1
+        self._pad = 0
+
+        self._atlas = smilies.get_atlas(self._pixel_size)
+        self._codes = [codes[0] for path, hint, codes in smilies.THEME]
+
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
+        self.connect('draw', self.__draw_cb)
+        self.connect('button-press-event', self.__button_press_cb)
+
+    def set_width(self, width):
+        '''Lay the smilies out in as many columns as fit in width.'''
+        button_size = self._pixel_size + self._spacing
+        self._columns = max(1, int(width / button_size))
+        self._pad = int((width - self._columns * button_size) / 2)
+        rows = -(-len(self._codes) // self._columns)
+        self.set_size_request(
+            width, 2 * self._pad + rows * button_size - self._spacing)
+        self.queue_draw()
+
+    def _cell_position(self, index):
+        button_size = self._pixel_size + self._spacing
+        row, column = divmod(index, self._columns)
+        return (self._pad + column * button_size,
+                self._pad + row * button_size)
+
+    def _cell_at(self, x, y):
+        button_size = self._pixel_size + self._spacing
+        column, dx = divmod(int(x) - self._pad, button_size)
+        row, dy = divmod(int(y) - self._pad, button_size)
+        if column < 0 or column >= self._columns or row < 0 or \
+                dx >= self._pixel_size or dy >= self._pixel_size:
+            return None
+        index = row * self._columns + column
+        if index >= len(self._codes):
+            return None
+        return index
+
+    def __draw_cb(self, widget, cr):
+        size = self._pixel_size
+        x1, y1, x2, y2 = cr.clip_extents()
+        for index in range(len(self._codes)):
+            x, y = self._cell_position(index)
+            if x + size < x1 or x > x2 or y + size < y1 or y > y2:
+                continue
+            cr.save()
+            cr.rectangle(x, y, size, size)
+            cr.clip()
+            Gdk.cairo_set_source_pixbuf(cr, self._atlas, x - index * size, y)
+            cr.paint()
+            cr.restore()
+        return False
+
+    def __button_press_cb(self, widget, event):
+        index = self._cell_at(event.x, event.y)
+        if index is not None:
+            self.emit('smiley-activated', self._codes[index])
+            return True
+        return False
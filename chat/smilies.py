@@ -18,10 +18,17 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import re
+import hashlib
+import logging
+from collections import OrderedDict
+from collections.abc import Mapping
 from gettext import gettext as _
+from gi.repository import GLib
 from gi.repository import GdkPixbuf
 from sugar3.graphics import style
 from sugar3.activity.activity import get_bundle_path
+from sugar3.activity.activity import get_activity_root
 
 THEME = \
     [
@@ -140,14 +147,51 @@ THEME = \
     ]
 
 SMILIES_SIZE = int(style.STANDARD_ICON_SIZE * 0.75)
-_catalog = {}
 
+# Rasterized pixbufs are kept for this many theme entries at most
+_CACHE_SIZE = 32
 
-def _smiley_to_theme_name(smiley):
-    for theme in THEME:
-        if smiley in theme[2]:
-            return theme[0]
-    return None
+# Built by init(): a single alternation of every smiley code, longest
+# codes first so that the leftmost match is also the longest one, and
+# the code -> (theme name, path, is_unicode) table used by parse().
+_pattern = None
+_codes = {}
+_cache_path = None
+
+# Bumped every time init() builds the theme, see get_generation()
+_generation = 0
+
+# theme name -> pixbuf, least recently used first
+_pixbufs = OrderedDict()
+
+# icon size -> pixbuf with the whole theme, see get_atlas()
+_atlases = {}
+
+# icon size -> [pixbuf, number of icons drawn] of the atlases being
+# drawn, see _draw_atlas_icon()
+_partial_atlases = {}
+
+
+class _Catalog(Mapping):
+    '''Smiley code -> pixbuf, rasterized on first use.'''
+
+    def __getitem__(self, code):
+        if _pattern is None:
+            init()
+        return _get_pixbuf(code)
+
+    def __iter__(self):
+        if _pattern is None:
+            init()
+        return iter(_codes)
+
+    def __len__(self):
+        if _pattern is None:
+            init()
+        return len(_codes)
+
+
+_catalog = _Catalog()
 
 
 def parse(text):
@@ -157,58 +201,198 @@ def parse(text):
     :returns:
     array of string parts and pixbufs
     '''
-    if not _catalog:
+    if _pattern is None:
         init()
 
-    result = [text]
-
-    for smiley in sorted(list(_catalog.keys()), key=lambda x: - len(x)):
-        new_result = []
-        for word in result:
-            if isinstance(word, GdkPixbuf.Pixbuf):
-                new_result.append(word)
-            else:
-                parts = word.split(smiley)
-                for i in parts[:-1]:
-                    name = _smiley_to_theme_name(smiley)
-                    new_result.append(i)
-                    if name is not None and 'unicode' in name:
-                        new_result.append(smiley)
-                    else:
-                        new_result.append(_catalog[smiley])
-                new_result.append(parts[-1])
-        result = new_result
+    # With one capturing group, split() alternates plain text (even
+    # indexes) with the smiley codes it found (odd indexes).
+    result = _pattern.split(text)
+    for i in range(1, len(result), 2):
+        if not _codes[result[i]][2]:
+            result[i] = _get_pixbuf(result[i])
 
     return result
 
 
+def get_generation():
+    '''Return a number that changes whenever the theme is initialized,
+    so that callers caching parse() results know when to drop them.
+    '''
+    return _generation
+
+
 def init():
-    if _catalog:
+    '''Resolve the icon path of every THEME entry and build the parser.
+    No icon is rasterized here, see _get_pixbuf() and prewarm().
+    '''
+    global _pattern, _cache_path, _generation
+
+    if _pattern is not None:
         return
 
     svg_dir = os.path.join(get_bundle_path(), 'icons', 'smilies')
+    _cache_path = _cache_dir(svg_dir)
 
     for index, (name, hint, codes) in enumerate(THEME):
         archivo = os.path.join(svg_dir, '%s.svg' % (name))
-        if name[0:7] == 'unicode':
-            # Create the icon from unicode character on the fly
-            pl = GdkPixbuf.PixbufLoader.new_with_type('svg')
-            pl.write(_generate_svg(codes[0]))
-            pl.close()
-            pixbuf = pl.get_pixbuf()
+        is_unicode = name[0:7] == 'unicode'
+        if is_unicode and not os.path.exists(archivo):
+            # Keep generated icons out of the (possibly read-only) bundle
+            archivo = os.path.join(_cache_path, '%s.svg' % (name))
             if not os.path.exists(archivo):
-                try:
-                    fd = open(archivo, 'w')
-                    fd.write(_generate_svg(codes[0]))
-                    fd.close()
-                except IOError:
-                    pass
-        else:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                archivo, SMILIES_SIZE, SMILIES_SIZE)
+                _write_cache(archivo, _generate_svg(codes[0]))
+
         for i in codes:
-            _catalog[i] = pixbuf
-            THEME[index] = (archivo, hint, codes)
+            _codes[i] = (name, archivo, is_unicode)
+        THEME[index] = (archivo, hint, codes)
+
+    _pattern = re.compile('(%s)' % '|'.join(
+        re.escape(code) for code in sorted(_codes, key=lambda x: - len(x))))
+    _generation += 1
+
+
+def prewarm(atlas_size=None):
+    '''Rasterize the picture smilies, then draw the atlas of atlas_size
+    if any, one icon per main loop idle call.
+    Returns the GLib source id.
+    '''
+    init()
+    queue = []
+    for path, hint, codes in THEME:
+        name, path, is_unicode = _codes[codes[0]]
+        if not is_unicode and name not in _pixbufs:
+            queue.append(codes[0])
+    del queue[_CACHE_SIZE:]
+    queue.reverse()
+
+    def _prewarm_idle_cb():
+        if queue:
+            _get_pixbuf(queue.pop())
+            return True
+        if atlas_size is None or atlas_size in _atlases:
+            return False
+        return not _draw_atlas_icon(atlas_size)
+
+    return GLib.idle_add(_prewarm_idle_cb)
+
+
+def _get_pixbuf(code):
+    name, path, is_unicode = _codes[code]
+    try:
+        pixbuf = _pixbufs.pop(name)
+    except KeyError:
+        png = os.path.join(_cache_path, '%s.png' % (name))
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(png)
+        except GLib.Error:
+            pixbuf = _rasterize(path, code, is_unicode)
+            _write_cache(png, pixbuf)
+        if len(_pixbufs) >= _CACHE_SIZE:
+            _pixbufs.popitem(last=False)
+    _pixbufs[name] = pixbuf
+    return pixbuf
+
+
+def get_atlas(size):
+    '''Return one pixbuf with every THEME icon at size x size pixels,
+    side by side in THEME order.
+    '''
+    init()
+    try:
+        return _atlases[size]
+    except KeyError:
+        pass
+
+    while not _draw_atlas_icon(size):
+        pass
+    return _atlases[size]
+
+
+def _draw_atlas_icon(size):
+    '''Draw the next icon of the atlas at size, unless it is cached.
+    Returns True once the atlas is in _atlases.
+    '''
+    if size in _atlases:
+        return True
+    if size not in _partial_atlases:
+        png = os.path.join(_cache_path, 'atlas-%d.png' % (size))
+        try:
+            _atlases[size] = GdkPixbuf.Pixbuf.new_from_file(png)
+            return True
+        except GLib.Error:
+            atlas = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                         size * len(THEME), size)
+            atlas.fill(0)
+            _partial_atlases[size] = [atlas, 0]
+
+    atlas, index = _partial_atlases[size]
+    path, hint, codes = THEME[index]
+    icon = GdkPixbuf.Pixbuf.new_from_file_at_size(path, size, size)
+    width = min(icon.get_width(), size)
+    height = min(icon.get_height(), size)
+    icon.copy_area(0, 0, width, height, atlas,
+                   index * size + (size - width) // 2, (size - height) // 2)
+    index += 1
+    if index < len(THEME):
+        _partial_atlases[size][1] = index
+        return False
+
+    del _partial_atlases[size]
+    _write_cache(os.path.join(_cache_path, 'atlas-%d.png' % (size)), atlas)
+    _atlases[size] = atlas
+    return True
+
+
+def _rasterize(path, code, is_unicode):
+    if is_unicode:
+        # Create the icon from unicode character on the fly
+        pl = GdkPixbuf.PixbufLoader.new_with_type('svg')
+        pl.write(_generate_svg(code))
+        pl.close()
+        return pl.get_pixbuf()
+    return GdkPixbuf.Pixbuf.new_from_file_at_size(
+        path, SMILIES_SIZE, SMILIES_SIZE)
+
+
+def _cache_dir(svg_dir):
+    '''Directory holding the rasterized smilies.
+    Entries are only valid for one icon size, zoom factor and theme, so
+    all three are part of the directory name.  The theme includes the
+    modification time and size of each SVG of svg_dir, so that redrawn
+    icons are rasterized again.
+    '''
+    digest = hashlib.sha1()
+    for name, hint, codes in THEME:
+        name = os.path.splitext(os.path.basename(name))[0]
+        try:
+            stat = os.stat(os.path.join(svg_dir, '%s.svg' % (name)))
+            version = '%s\t%d' % (stat.st_mtime, stat.st_size)
+        except OSError:
+            # Generated, see _generate_svg
+            version = ''
+        digest.update(('%s\t%s\t%s\n' % (
+            name, version, '\t'.join(codes))).encode('utf-8'))
+    return os.path.join(
+        get_activity_root(), 'data', 'smilies', '%d-%s-%s' % (
+            SMILIES_SIZE, style.ZOOM_FACTOR, digest.hexdigest()[:12]))
+
+
+def _write_cache(path, data):
+    '''Store an SVG (bytes) or a pixbuf (as PNG) in the cache.
+    Failing to write is not fatal, the next start will rasterize again.
+    '''
+    tmp_path = path + '.tmp'
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if isinstance(data, GdkPixbuf.Pixbuf):
+            data.savev(tmp_path, 'png', [], [])
+        else:
+            with open(tmp_path, 'wb') as fd:
+                fd.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, GLib.Error) as error:
+        logging.warning('Could not cache smiley %s: %s', path, error)
 
 
 def _generate_svg(letter):
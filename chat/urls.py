@@ -0,0 +1,130 @@
+# Copyright 2009-14 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''Recognize words that look like links.
+
+is_url(word) accepts exactly the words for which
+
+    re.match('((http|ftp)s?://)?'
+             '(([-a-zA-Z0-9]+[.])+[-a-zA-Z0-9]{2,}|([0-9]{1,3}[.]){3}[0-9]{1,3})'
+             '(:[1-9][0-9]{0,4})?(/[-a-zA-Z0-9/%~@&_+=;:,.?#]*[a-zA-Z0-9/])?',
+             word)
+
+succeeds, but only uses string operations that each look at a
+character a bounded number of times, so the time it takes is linear in
+the length of the word whatever the word is.  The regular expression
+has nested quantifiers and its running time depends on how much the
+engine backtracks.
+
+Run this module to compare both on a corpus and time them.
+'''
+
+import string
+
+_LABEL = string.ascii_letters + string.digits + '-'
+_SCHEMES = ('http://', 'https://', 'ftp://', 'ftps://')
+
+
+def _prefix(word, chars):
+    ''' Return the longest prefix of word made of chars '''
+    return word[:len(word) - len(word.lstrip(chars))]
+
+
+def _is_host(word):
+    ''' A dotted name: non-empty labels separated by single dots and,
+    after the first label, one label of at least two characters. '''
+    name = _prefix(word, _LABEL + '.')
+    if not name or name[0] == '.':
+        return False
+    # Labels after an empty one can not be reached
+    empty = name.find('..')
+    if empty >= 0:
+        name = name[:empty]
+    for label in name.split('.')[1:]:
+        if len(label) >= 2:
+            return True
+    return False
+
+
+def _is_ipv4(word):
+    ''' Four runs of one to three digits separated by dots. '''
+    parts = _prefix(word, string.digits + '.').split('.', 3)
+    if len(parts) < 4 or parts[3][:1] in ('', '.'):
+        return False
+    for part in parts[:3]:
+        if not 1 <= len(part) <= 3:
+            return False
+    return True
+
+
+def is_url(word):
+    '''Return True if word starts with something that looks like a link.
+    The optional port and path are never needed for a match, so only
+    the scheme and the host are checked.
+    '''
+    if '.' not in word:
+        return False
+    if word.startswith(_SCHEMES):
+        word = word[word.index('//') + 2:]
+    return _is_host(word) or _is_ipv4(word)
+
+
+if __name__ == '__main__':
+    import re
+    import random
+    import timeit
+
+    url_regexp = re.compile(
+        '((http|ftp)s?://)?'
+        '(([-a-zA-Z0-9]+[.])+[-a-zA-Z0-9]{2,}|([0-9]{1,3}[.]){3}[0-9]{1,3})'
+        '(:[1-9][0-9]{0,4})?(/[-a-zA-Z0-9/%~@&_+=;:,.?#]*[a-zA-Z0-9/])?')
+
+    corpus = [
+        '', '.', 'a', 'ab', 'a.', '.ab', 'a.b', 'a.bc', 'a..bc', 'a.b.cd',
+        'a.b.c', 'a-b.c-d', 'sugarlabs.org', 'www.sugarlabs.org/',
+        'http://', 'http://a', 'http://a.bc', 'https://a.b.cd:8080/x?y=z',
+        'ftp://1.2.3.4', 'ftps://1.2.3', 'httpx://a.bc', 'http:/a.bc',
+        'HTTP://a.bc', '1.2.3.4', '1.2.3', '1234.1.1.1', '1.2.3.a',
+        '12.34.56.789', '999.1.1.1:80', 'x:a.bc', 'a.bc:0', 'a_b.cd',
+        ':-)', 'hello', 'e.g.', 'i.e.', '...', 'a.b.c.d.e.f.gh',
+        'mailto:a@b.cd', 'a@b.cd', 'é.org', 'a.éé',
+    ]
+    rng = random.Random(0)
+    alphabet = 'ab1.-:/h'
+    for i in range(100000):
+        corpus.append(''.join(rng.choice(alphabet)
+                              for j in range(rng.randint(0, 12))))
+        corpus.append(rng.choice(_SCHEMES) + corpus[-1])
+
+    mismatches = [word for word in corpus
+                  if is_url(word) != (url_regexp.match(word) is not None)]
+    print('%d words, %d mismatches %r' % (
+        len(corpus), len(mismatches), mismatches[:10]))
+
+    adversarial = {
+        'dotted': 'a.' * 5000,
+        'labels': ('a' * 50 + '.') * 200 + '!',
+        'digits': '1.' * 5000,
+        'path': 'a.bc/' + 'a' * 10000 + '!',
+        'plain': 'x' * 10000,
+    }
+    for name, word in sorted(adversarial.items()):
+        print('%-8s regexp %.6fs  is_url %.6fs' % (
+            name,
+            min(timeit.repeat(lambda: url_regexp.match(word),
+                              number=10, repeat=3)) / 10,
+            min(timeit.repeat(lambda: is_url(word),
+                              number=10, repeat=3)) / 10))